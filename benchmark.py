@@ -0,0 +1,427 @@
+# Benchmarks for the data pipeline and network
+# Run with: python benchmark.py --bench <name> [--data_dir ...]
+
+import os, copy, math, time, shutil, tempfile
+import cv2, h5py
+import numpy as np
+from pathlib import Path
+
+from config import get_config, print_usage
+from utils.checkData import check_data
+from utils.dataLoader import ArraySplit, VideoData, MemmapData, BatchLoader, export_memmap
+from utils.preprocessing import _resize, _dataset_options, hdf5plugin
+from utils.processInfo import frame_velocity
+
+
+def bench_resize(config):
+    """Compare speed and output of the resize backends against skimage"""
+
+    # full resolution dashcam stills are representative of video frames
+    paths = sorted(Path(config.data_dir).glob('frame-10s/*.jpg'))[:config.bench_samples]
+    if not paths:
+        print("Error: no images found in", Path(config.data_dir) / 'frame-10s')
+        return False
+    images = [cv2.imread(str(path), 1) for path in paths]
+    print("Resizing {} images of shape {}".format(len(images), images[0].shape))
+
+    # current packaged output is the reference
+    reference = [_resize(image, backend='skimage') for image in images]
+
+    passed = True
+    for backend in ['skimage', 'opencv']:
+        start = time.time()
+        resized = [_resize(image, backend=backend) for image in images]
+        elapsed = (time.time() - start) / len(images)
+
+        diff = np.abs(np.asarray(resized, dtype=np.int16) - np.asarray(reference, dtype=np.int16))
+        ok = diff.mean() <= config.resize_tolerance
+        passed = passed and ok
+        print("{:>8}: {:7.2f} ms/image, mean abs diff {:.3f}, max abs diff {}, {}".format(
+            backend, elapsed * 1000, diff.mean(), diff.max(), "ok" if ok else "FAILED"))
+
+    return passed
+
+
+def bench_velocity(config):
+    """Compare speed and output of frame_velocity against the per-frame loop it replaced"""
+
+    # random location records, some with repeated timestamps, starting before or after the video
+    rng = np.random.RandomState(config.seed)
+    cases = []
+    for sample in range(config.bench_samples):
+        num = rng.randint(1, 45)
+        start_time = 1500000000000 + rng.randint(0, 1000)
+        timestamp = start_time + np.cumsum(rng.randint(0 if sample % 7 == 0 else 900, 1100, num)) - rng.randint(0, 3000)
+        cases.append((timestamp, rng.rand(num) * 30, rng.rand(num) * 360, start_time,
+                      rng.randint(1, 1300), rng.choice([10.0, 8.0, 31 / 3])))
+    print("Interpolating velocities of {} random videos".format(len(cases)))
+
+    results = {}
+    for name, fn in [("loop", _frame_velocity_loop), ("vectorized", frame_velocity)]:
+        start = time.time()
+        # repeated timestamps give 0 / 0 in both versions
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results[name] = [fn(*case) for case in cases]
+        print("{:>10}: {:7.3f} ms/video".format(name, (time.time() - start) / len(cases) * 1000))
+
+    # exact match, including NaN of repeated timestamps
+    mismatched = sum(1 for a, b in zip(results["loop"], results["vectorized"])
+                     if a.shape != b.shape or not np.allclose(a, b, rtol=0, atol=0, equal_nan=True))
+    print("{} of {} videos differ, {}".format(mismatched, len(cases), "FAILED" if mismatched else "ok"))
+
+    return mismatched == 0
+
+
+def _frame_velocity_loop(timestamp, speed, course, start_time, num_frames, hz):
+    """Reference frame_velocity, the per-frame loop formerly in read_json"""
+
+    velocity = np.zeros((len(course), 2), dtype=np.float32)
+    for i in range(len(course)):
+        t = math.radians(course[i])
+        velocity[i, :] = np.array([math.sin(t) * speed[i], math.cos(t) * speed[i]])
+
+    frame_velocity = np.zeros((num_frames, 2), dtype=np.float32)
+    t_prev = 0
+    for frame in range(num_frames):
+        t_cur = frame * 1000 / hz + start_time
+        if t_cur < timestamp[0]:
+            frame_velocity[frame, :] = velocity[0, :]
+            continue
+        try:
+            while timestamp[t_prev + 1] < t_cur:
+                t_prev += 1
+        except IndexError:
+            frame_velocity[frame, :] = velocity[t_prev, :]
+            continue
+        else:
+            t_next = t_prev + 1
+            t1 = t_cur - timestamp[t_prev]
+            t2 = timestamp[t_next] - t_cur
+            r1 = t2 / (t1 + t2)
+            r2 = t1 / (t1 + t2)
+            frame_velocity[frame, :] = r1 * velocity[t_prev, :] + r2 * velocity[t_next, :]
+
+    return frame_velocity[::10, :]
+
+
+def bench_layout(config):
+    """Compare file size and random frame read latency of the H5 storage layouts"""
+
+    # layouts as (name, chunked, compression, shuffle)
+    layouts = [
+        ("contiguous", False, 'none', False),
+        ("chunked", True, 'none', False),
+        ("gzip", True, 'gzip', False),
+        ("shuffle+gzip", True, 'gzip', True),
+    ]
+    if hdf5plugin is not None:
+        layouts += [("lz4", True, 'lz4', False), ("shuffle+lz4", True, 'lz4', True)]
+    else:
+        print("hdf5plugin not installed, skipping lz4 layouts")
+
+    # copy a subset of the packaged data into every layout
+    src = h5py.File('videoData.h5', 'r')
+    names = [name for name in src if 'video' in src[name]][:config.bench_samples]
+    print("Benchmarking {} videos from videoData.h5".format(len(names)))
+
+    rng = np.random.RandomState(0)
+    tmp_dir = tempfile.mkdtemp()
+    for layout, chunked, compression, shuffle in layouts:
+        path = os.path.join(tmp_dir, layout + '.h5')
+        with h5py.File(path, 'w') as dst:
+            for name in names:
+                group = dst.create_group(name)
+                for key in src[name]:
+                    data = src[name][key][()]
+                    group.create_dataset(key, data=data, dtype=data.dtype,
+                                         **_dataset_options(key, data.shape, chunked, compression, shuffle))
+
+        # read random single frames the way the training loader does
+        reads = [names[i] for i in rng.randint(len(names), size=config.bench_reads)]
+        latency = []
+        with h5py.File(path, 'r') as f:
+            for name in reads:
+                video = f[name]['video']
+                start = time.time()
+                video[rng.randint(video.shape[0])]
+                latency.append(time.time() - start)
+        latency = np.asarray(latency) * 1000
+
+        print("{:>13}: {:8.1f} MB, frame read p50 {:.3f} ms, p99 {:.3f} ms".format(
+            layout, os.path.getsize(path) / 2**20, np.percentile(latency, 50), np.percentile(latency, 99)))
+        os.remove(path)
+
+    os.rmdir(tmp_dir)
+    src.close()
+    print("Note: files were just written, so reads are likely served from the page cache")
+
+
+def bench_input(config):
+    """Compare training steps/sec of feed_dict batches and the tf.data input pipeline"""
+
+    # TensorFlow is only needed by the network benchmarks
+    import tensorflow as tf
+    from network import Network
+
+    rng = np.random.RandomState(0)
+    data = _random_data(config)
+    x_shp, _, lstm_x_shp, _, speed_x_shp, _ = data.shapes
+    print("Timing {} steps at batch size {}".format(config.bench_steps, config.batch_size))
+
+    for pipeline in ["feed", "dataset"]:
+        tf.reset_default_graph()
+        net = Network(x_shp, lstm_x_shp, config, speed_x_shp,
+                      train_data=data if pipeline == "dataset" else None)
+
+        with tf.Session() as sess:
+            tf.keras.backend.set_session(sess)
+            sess.run(tf.global_variables_initializer())
+            sess.run(net.n_assign_op, feed_dict={net.n_mean_in: 128.0, net.n_range_in: 128.0})
+
+            def step():
+                feed_dict = None
+                if pipeline == "feed":
+                    # assemble the batch as Network.train does
+                    ind_cur = rng.choice(len(data), config.batch_size, replace=True)
+                    feed_dict = dict(zip(net._inputs(), data.batch(ind_cur)))
+                sess.run(net.optim, feed_dict=feed_dict)
+
+            # first step builds kernels and fills the prefetch buffer
+            step()
+            start = time.time()
+            for _ in range(config.bench_steps):
+                step()
+            elapsed = time.time() - start
+
+        # stop the loader workers, so they do not run during the next pipeline
+        if net.loader is not None:
+            net.loader.close()
+        print("{:>8}: {:.2f} steps/sec".format(pipeline, config.bench_steps / elapsed))
+
+
+def bench_tower(config):
+    """Compare graph build time and training step latency of separate and shared AlexNet towers"""
+
+    # TensorFlow is only needed by the network benchmarks
+    import tensorflow as tf
+    from network import Network
+
+    rng = np.random.RandomState(0)
+    data = _random_data(config)
+    x_shp, _, lstm_x_shp, _, speed_x_shp, _ = data.shapes
+    print("Timing {} steps at batch size {}".format(config.bench_steps, config.batch_size))
+
+    for share_tower in [False, True]:
+        tf.reset_default_graph()
+        tower_config = copy.copy(config)
+        tower_config.share_tower = share_tower
+        start = time.time()
+        net = Network(x_shp, lstm_x_shp, tower_config, speed_x_shp)
+        build = time.time() - start
+        num_ops = len(tf.get_default_graph().get_operations())
+
+        with tf.Session() as sess:
+            tf.keras.backend.set_session(sess)
+            sess.run(tf.global_variables_initializer())
+            sess.run(net.n_assign_op, feed_dict={net.n_mean_in: 128.0, net.n_range_in: 128.0})
+
+            latency = []
+            # first step builds kernels
+            for _ in range(config.bench_steps + 1):
+                feed_dict = dict(zip(net._inputs(), data.batch(rng.choice(len(data), config.batch_size, replace=True))))
+                start = time.time()
+                sess.run(net.optim, feed_dict=feed_dict)
+                latency.append(time.time() - start)
+            latency = np.asarray(latency[1:]) * 1000
+
+        print("{:>8}: build {:.2f} s, {} ops, step p50 {:.1f} ms, p99 {:.1f} ms".format(
+            "shared" if share_tower else "separate", build, num_ops,
+            np.percentile(latency, 50), np.percentile(latency, 99)))
+
+
+def bench_inference(config):
+    """Report latency of the exported inference graph for single frames and batches"""
+
+    # TensorFlow is only needed by the network benchmarks
+    from inference import Predictor
+
+    predictor = Predictor(config.export_dir)
+    data = _random_data(config)
+    seg_x, _, lstm_x, _, speed_x, _ = data.batch(np.arange(config.batch_size))
+    print("Timing {} calls, batch size {}".format(config.bench_steps, config.batch_size))
+
+    calls = [
+        ("segment x1", lambda: predictor.segment(seg_x[0])),
+        ("segment xN", lambda: predictor.segment(seg_x)),
+        ("actions x1", lambda: predictor.actions(lstm_x[0], speed_x[0])),
+        ("actions xN", lambda: predictor.actions(lstm_x, speed_x)),
+    ]
+    for name, call in calls:
+        # first call builds kernels
+        call()
+        latency = []
+        for _ in range(config.bench_steps):
+            start = time.time()
+            call()
+            latency.append(time.time() - start)
+        latency = np.asarray(latency) * 1000
+
+        print("{:>11}: p50 {:.2f} ms, p99 {:.2f} ms".format(
+            name, np.percentile(latency, 50), np.percentile(latency, 99)))
+
+    predictor.close()
+
+
+def bench_precision(config):
+    """Report accuracy and latency of the exported graph at each precision on the held-out test split"""
+
+    # TensorFlow is only needed by the network benchmarks
+    from inference import Predictor, export
+
+    # test split as in training, falling back to H5 order without the data directory
+    index = check_data(Path(config.data_dir), config.seed)
+    data = VideoData('videoData.h5', names=index.names if index is not None else None,
+                     window_length=config.window_length, window_stride=config.window_stride,
+                     window_end=config.window_end).test
+    if len(data) == 0:
+        print("Error: no test samples in videoData.h5")
+        return False
+    seg_x, seg_y, lstm_x, _, speed_x, _ = data.batch(np.arange(min(len(data), config.bench_samples)))
+    batches = range(0, len(seg_x), config.batch_size)
+    print("Evaluating {} test samples, timing {} calls at batch size {}".format(
+        len(seg_x), config.bench_steps, config.batch_size))
+
+    # variants as (name, precision, quantize_weights)
+    variants = [("float32", "float32", False), ("float16", "float16", False), ("int8", "float32", True)]
+    tmp_dir = tempfile.mkdtemp()
+    reference = None
+    for name, precision, quantize_weights in variants:
+        variant = copy.copy(config)
+        variant.precision = precision
+        variant.quantize_weights = quantize_weights
+        variant.export_dir = os.path.join(tmp_dir, name)
+        path = export(variant)
+        if path is None:
+            shutil.rmtree(tmp_dir)
+            return False
+
+        predictor = Predictor(path)
+        seg_pred = np.concatenate([predictor.segment(seg_x[i:i + config.batch_size]) for i in batches])
+        actions = np.concatenate([np.argmax(predictor.actions(lstm_x[i:i + config.batch_size], speed_x[i:i + config.batch_size]), axis=-1)
+                                  for i in batches])
+        if reference is None:
+            reference = seg_pred, actions
+
+        # first call builds kernels
+        predictor.segment(seg_x[:config.batch_size])
+        latency = []
+        for _ in range(config.bench_steps):
+            start = time.time()
+            predictor.segment(seg_x[:config.batch_size])
+            latency.append(time.time() - start)
+        latency = np.asarray(latency) * 1000
+        predictor.close()
+
+        print("{:>8}: {:6.1f} MB, seg accuracy {:.4f}, agreement with float32: pixels {:.4f}, actions {:.4f}, "
+              "segment p50 {:.2f} ms, p99 {:.2f} ms".format(
+                  name, os.path.getsize(path) / 2**20, np.mean(seg_pred == seg_y),
+                  np.mean(seg_pred == reference[0]), np.mean(actions == reference[1]),
+                  np.percentile(latency, 50), np.percentile(latency, 99)))
+
+    shutil.rmtree(tmp_dir)
+
+
+def _random_data(config):
+    """Random training split with the shapes of the packaged data"""
+    rng = np.random.RandomState(0)
+    num = max(config.bench_samples, config.batch_size)
+    x = rng.randint(0, 256, (num, 244, 244, 3)).astype(np.uint8)
+    y = rng.randint(0, config.num_class, (num, 244, 244)).astype(np.uint8)
+    lstm_x = rng.randint(0, 256, (num, config.window_length, 244, 244, 3)).astype(np.uint8)
+    speed_x = rng.randn(num, config.window_length, 2).astype(np.float32)
+    speed_y = rng.randint(1, 5, num).astype(np.int64)
+    return ArraySplit((x, y, lstm_x, y, speed_x, speed_y))
+
+
+def bench_loader(config):
+    """Compare random batch throughput of videoData.h5 and the exported flat arrays"""
+
+    tmp_dir = tempfile.mkdtemp()
+    start = time.time()
+    export_memmap('videoData.h5', tmp_dir)
+    print("Exported videoData.h5 in {:.1f} s".format(time.time() - start))
+
+    for data_format, data_class, path in [("h5", VideoData, 'videoData.h5'), ("memmap", MemmapData, tmp_dir)]:
+        data = data_class(path, window_length=config.window_length, window_stride=config.window_stride,
+                          window_end=config.window_end).train
+        # same batches for every format
+        rng = np.random.RandomState(0)
+        batches = [rng.choice(len(data), config.batch_size, replace=True) for _ in range(config.bench_steps)]
+
+        start = time.time()
+        for ind_cur in batches:
+            data.batch(ind_cur)
+        elapsed = time.time() - start
+
+        print("{:>8}: {:.2f} batches/sec, {:.1f} samples/sec".format(
+            data_format, len(batches) / elapsed, len(batches) * config.batch_size / elapsed))
+        del data
+
+    shutil.rmtree(tmp_dir)
+    print("Note: files were just written, so reads are likely served from the page cache")
+
+
+def bench_workers(config):
+    """Compare batch throughput of the batch loader for an increasing number of workers"""
+
+    if config.data_format == "memmap":
+        data = MemmapData(config.memmap_dir, window_length=config.window_length,
+                          window_stride=config.window_stride, window_end=config.window_end).train
+    else:
+        data = VideoData('videoData.h5', window_length=config.window_length,
+                         window_stride=config.window_stride, window_end=config.window_end).train
+    print("Timing {} batches of size {} from {}".format(config.bench_steps, config.batch_size, config.data_format))
+
+    for workers in sorted({0, 1, 2, 4, config.loader_workers}):
+        loader = BatchLoader(data, config.batch_size, workers, config.seed)
+        # first batches include starting the workers
+        for _ in range(2 * workers + 1):
+            next(loader)
+        start = time.time()
+        for _ in range(config.bench_steps):
+            next(loader)
+        elapsed = time.time() - start
+        loader.close()
+
+        print("{:>3} workers: {:.2f} batches/sec".format(workers, config.bench_steps / elapsed))
+    print("Note: {} CPUs available".format(os.cpu_count()))
+
+
+def main(config):
+    """The main function."""
+
+    benchmarks = {
+        "resize": bench_resize,
+        "velocity": bench_velocity,
+        "layout": bench_layout,
+        "input": bench_input,
+        "loader": bench_loader,
+        "workers": bench_workers,
+        "tower": bench_tower,
+        "inference": bench_inference,
+        "precision": bench_precision,
+    }
+    if benchmarks[config.bench](config) is False:
+        exit(1)
+
+
+if __name__ == "__main__":
+
+    # Parse configuration
+    config, unparsed = get_config()
+    # If we have unparsed arguments, print usage and exit
+    if len(unparsed) > 0:
+        print_usage()
+        exit(1)
+
+    main(config)
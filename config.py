@@ -36,6 +36,36 @@ train_arg.add_argument("--package_data", type=bool,
                        default=True,
                        help="Package data into H5 Format.")
 
+train_arg.add_argument("--repackage", type=str2bool,
+                       default=False,
+                       help="Package all videos again, even those whose H5 group is up to date")
+
+train_arg.add_argument("--seed", type=int,
+                       default=0,
+                       help="Seed for shuffling samples before the train/val/test split")
+
+train_arg.add_argument("--package_workers", type=int,
+                       default=1,
+                       help="Number of processes decoding videos while packaging data")
+
+train_arg.add_argument("--resize_backend", type=str,
+                       default="skimage",
+                       choices=["skimage", "opencv"],
+                       help="Library used to downsample frames while packaging data")
+
+train_arg.add_argument("--h5_chunked", type=str2bool,
+                       default=False,
+                       help="Store packaged videos with one frame per H5 chunk")
+
+train_arg.add_argument("--h5_compression", type=str,
+                       default="none",
+                       choices=["none", "gzip", "lz4"],
+                       help="Compression of packaged data, lz4 requires hdf5plugin")
+
+train_arg.add_argument("--h5_shuffle", type=str2bool,
+                       default=False,
+                       help="Apply the H5 shuffle filter to packaged data")
+
 train_arg.add_argument("--learning_rate", type=float,
                        default=1e-3,
                        help="Learning rate (gradient step size)")
@@ -44,6 +74,49 @@ train_arg.add_argument("--batch_size", type=int,
                        default=1,
                        help="Size of each training batch")
 
+train_arg.add_argument("--input_pipeline", type=str,
+                       default="feed",
+                       choices=["feed", "dataset"],
+                       help="Feed batches from Python, or use a prefetching tf.data pipeline")
+
+train_arg.add_argument("--prefetch", type=int,
+                       default=2,
+                       help="Number of batches the tf.data pipeline prepares ahead of training")
+
+train_arg.add_argument("--loader_workers", type=int,
+                       default=0,
+                       help="Number of processes assembling training batches, 0 to read them in the training process")
+
+train_arg.add_argument("--data_format", type=str,
+                       default="h5",
+                       choices=["h5", "memmap"],
+                       help="Read training data from videoData.h5, or from flat arrays exported to memmap_dir")
+
+train_arg.add_argument("--memmap_dir", type=str,
+                       default="memmapData",
+                       help="Directory of the flat arrays, exported again from videoData.h5 when its videos changed")
+
+train_arg.add_argument("--feature_cache", type=str,
+                       default="",
+                       help="H5 file of AlexNet features of every frame, computed with the pretrained weights, to train the LSTM branch on. The tower is frozen. "
+                            "Stored as compressed float16, up to ~0.66 MB per frame (float32 would be ~1.3 MB, ~7.5x the packaged frames). Disabled if empty")
+
+train_arg.add_argument("--feature_cache_size", type=int,
+                       default=256,
+                       help="Number of frame features kept in memory by the feature cache")
+
+train_arg.add_argument("--window_length", type=int,
+                       default=2,
+                       help="Number of frames in each LSTM input window")
+
+train_arg.add_argument("--window_stride", type=int,
+                       default=0,
+                       help="Frames between the ends of consecutive windows of a video, 0 for one window ending at window_end")
+
+train_arg.add_argument("--window_end", type=int,
+                       default=29,
+                       help="Last frame of the window when window_stride is 0")
+
 train_arg.add_argument("--max_iter", type=int,
                        default=100,
                        help="Number of iterations to train")
@@ -55,6 +128,10 @@ train_arg.add_argument("--save_dir", type=str,
                        default="./save",
                        help="Directory to save the best model")
 
+train_arg.add_argument("--export_dir", type=str,
+                       default="./export",
+                       help="Directory of the frozen inference graph")
+
 # broken, so set to above number of training iterations
 train_arg.add_argument("--val_freq", type=int,
                        default=999999,
@@ -64,6 +141,10 @@ train_arg.add_argument("--report_freq", type=int,
                        default=20,
                        help="Summary interval")
 
+train_arg.add_argument("--image_freq", type=int,
+                       default=100,
+                       help="Segmentation image summary interval of training, also written at every validation. 0 disables both")
+
 # ----------------------------------------
 # Arguments for model
 model_arg = add_argument_group("Model")
@@ -88,11 +169,65 @@ model_arg.add_argument("--num_class", type=int,
                        default=41,
                        help="Number of classes in the dataset")
 
+model_arg.add_argument("--precision", type=str,
+                       default="float32",
+                       choices=["float32", "float16"],
+                       help="Compute dtype of AlexNet, weights are always stored in float32")
+
+model_arg.add_argument("--loss_scale", type=float,
+                       default=128.0,
+                       help="Loss scale of float16 training")
+
+model_arg.add_argument("--share_tower", type=str2bool,
+                       default=False,
+                       help="Run segmentation and LSTM frames through a single AlexNet pass")
+
 model_arg.add_argument("--activ_type", type=str,
                        default="relu",
                        choices=["relu", "tanh"],
                        help="Activation type")
 
+# ----------------------------------------
+# Arguments for inference
+inference_arg = add_argument_group("Inference")
+
+inference_arg.add_argument("--quantize_weights", type=str2bool,
+                           default=False,
+                           help="Store the weights of the exported graph as 8 bit integers")
+
+inference_arg.add_argument("--stream", type=str,
+                           default="",
+                           help="Video to predict actions for with the exported graph, exports the graph if empty")
+
+inference_arg.add_argument("--stream_info", type=str,
+                           default="",
+                           help="JSON info of the streamed video, velocities are zero if empty")
+
+# ----------------------------------------
+# Arguments for benchmarks
+bench_arg = add_argument_group("Benchmark")
+
+bench_arg.add_argument("--bench", type=str,
+                       default="resize",
+                       choices=["resize", "velocity", "layout", "input", "loader", "workers", "tower", "inference", "precision"],
+                       help="Benchmark to run with benchmark.py")
+
+bench_arg.add_argument("--bench_samples", type=int,
+                       default=50,
+                       help="Number of samples to benchmark on")
+
+bench_arg.add_argument("--bench_steps", type=int,
+                       default=50,
+                       help="Number of training steps to time")
+
+bench_arg.add_argument("--bench_reads", type=int,
+                       default=500,
+                       help="Number of random reads to time")
+
+bench_arg.add_argument("--resize_tolerance", type=float,
+                       default=2.0,
+                       help="Largest mean absolute difference from skimage allowed for a resize backend")
+
 
 def get_config():
     config, unparsed = parser.parse_known_args()
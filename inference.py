@@ -0,0 +1,307 @@
+
+# Export of the trained network to a frozen inference graph, and a predictor serving it
+# Export with: python inference.py [--save_dir ...] [--export_dir ...]
+# Stream a video with: python inference.py --stream <video> [--stream_info <json>]
+
+import os, copy, cv2
+import numpy as np
+import tensorflow as tf
+
+from config import get_config, print_usage
+from network import Network
+from utils.preprocessing import _resize, _sample_frames
+from utils.processInfo import parse_info, frame_velocity
+
+# file the frozen graph is written to in export_dir
+GRAPH_FILE = "frozen_model.pb"
+# names of the inputs and outputs kept in the frozen graph
+INPUT_NAMES = ["seg_x_in", "lstm_x_in", "lstm_speed_x"]
+OUTPUT_NAMES = ["Eval/seg_pred", "Eval/lstm_logits"]
+# LSTM frames and their AlexNet features, fed to run the tower and the LSTM head separately
+FEATURE_NAMES = ["Network/lstm_frames", "Network/lstm_features"]
+
+
+def export(config):
+    '''
+    Function to freeze the best model in "save_dir" into a GraphDef in "export_dir"
+
+    The inference graph is built without dropout, loss, optimizer or summaries, and all variables,
+    including the normalization statistics, are folded into constants. The tower computes in the
+    dtype of --precision, and with --quantize_weights the weights are stored as 8 bit integers
+
+    Parameters
+    ----------
+    config : argparse.Namespace
+        Configuration, see config.py
+
+    Returns
+    -------
+    path : string
+        Path to the frozen graph, None if there is no model to export
+
+    '''
+
+    checkpoint = tf.train.latest_checkpoint(config.save_dir)
+    if checkpoint is None:
+        print("Error: no model to export in", config.save_dir)
+        return
+
+    # towers share variables, separate towers let segmentation run without LSTM inputs,
+    # and the LSTM tower is kept for models trained on cached features
+    export_config = copy.copy(config)
+    export_config.share_tower = False
+    export_config.feature_cache = ""
+
+    graph = tf.Graph()
+    with graph.as_default():
+        T = config.window_length
+        net = Network((None, 244, 244, 3), (None, T, 244, 244, 3), export_config, (None, T, 2), training=False)
+
+        with tf.Session() as sess:
+            print("Restoring from {}...".format(checkpoint))
+            net.saver_best.restore(sess, checkpoint)
+            # keep only the ops needed for the outputs, with variables as constants
+            frozen = tf.graph_util.convert_variables_to_constants(
+                sess, graph.as_graph_def(), OUTPUT_NAMES)
+
+    if config.quantize_weights:
+        # large weights are stored as 8 bit integers with their range, and dequantized when run
+        from tensorflow.tools.graph_transforms import TransformGraph
+        frozen = TransformGraph(frozen, INPUT_NAMES + FEATURE_NAMES[:1], OUTPUT_NAMES + FEATURE_NAMES[1:],
+                                ["quantize_weights"])
+
+    os.makedirs(config.export_dir, exist_ok=True)
+    tf.train.write_graph(frozen, config.export_dir, GRAPH_FILE, as_text=False)
+    path = os.path.join(config.export_dir, GRAPH_FILE)
+    print("Exported {} ops to {}".format(len(frozen.node), path))
+
+    return path
+
+
+class Predictor:
+    '''
+    Runs the frozen graph written by export
+
+    Each prediction is a single call of a callable built once, so calls do not look up or
+    validate the fetches and feeds again
+
+    Parameters
+    ----------
+    path : string
+        Path to the frozen graph, or the directory holding it
+
+    '''
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            path = os.path.join(path, GRAPH_FILE)
+
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.sess = tf.Session(graph=self.graph)
+
+        seg_x, lstm_x, speed_x = [self.graph.get_tensor_by_name(name + ":0") for name in INPUT_NAMES]
+        seg_pred, lstm_logits = [self.graph.get_tensor_by_name(name + ":0") for name in OUTPUT_NAMES]
+        lstm_frames, lstm_features = [self.graph.get_tensor_by_name(name + ":0") for name in FEATURE_NAMES]
+        self.window_length = lstm_x.shape[1].value
+
+        self._segment = self.sess.make_callable(seg_pred, feed_list=[seg_x])
+        self._actions = self.sess.make_callable(lstm_logits, feed_list=[lstm_x, speed_x])
+        self._features = self.sess.make_callable(lstm_features, feed_list=[lstm_frames])
+        self._actions_from_features = self.sess.make_callable(lstm_logits, feed_list=[lstm_features, speed_x])
+
+    def segment(self, frames):
+        '''
+        Function to predict the class of every pixel
+
+        Parameters
+        ----------
+        frames : ndarray
+            One (244, 244, 3) frame or a (N, 244, 244, 3) batch, as packaged by package_data
+
+        Returns
+        -------
+        classes : ndarray
+            Class ids of shape (244, 244) or (N, 244, 244)
+
+        '''
+
+        single = frames.ndim == 3
+        classes = self._segment(np.asarray(frames[None] if single else frames, dtype=np.float32))
+        return classes[0] if single else classes
+
+    def actions(self, windows, velocities):
+        '''
+        Function to predict the action logits of LSTM windows
+
+        Parameters
+        ----------
+        windows : ndarray
+            One (T, 244, 244, 3) window or a (N, T, 244, 244, 3) batch, most recent frame first
+
+        velocities : ndarray
+            Velocity at the frames of the windows, (T, 2) or (N, T, 2)
+
+        Returns
+        -------
+        logits : ndarray
+            Logits of the 4 actions, of shape (4,) or (N, 4)
+
+        '''
+
+        single = windows.ndim == 4
+        if single:
+            windows, velocities = windows[None], velocities[None]
+        logits = self._actions(np.asarray(windows, dtype=np.float32), np.asarray(velocities, dtype=np.float32))
+        return logits[0] if single else logits
+
+    def features(self, frames):
+        """AlexNet features of a (N, 244, 244, 3) batch of LSTM frames"""
+        return self._features(np.asarray(frames, dtype=np.float32))
+
+    def actions_from_features(self, features, velocities):
+        """Action logits of one window from the features of its frames, most recent first, see actions"""
+        logits = self._actions_from_features(features, np.asarray(velocities, dtype=np.float32)[None])
+        return logits[0]
+
+    def close(self):
+        self.sess.close()
+
+
+def stream(predictor, frames, velocities, resize_backend='skimage'):
+    '''
+    Generator of the action predicted at every frame of a video or live source
+
+    Frames are resized as by package_data and run through AlexNet once each. The features and
+    velocities of the last window_length frames are kept in a ring buffer, so each prediction
+    only runs the tower on the new frame and the LSTM head on the buffered window
+
+    Parameters
+    ----------
+    predictor : Predictor object
+        Predictor of the exported graph
+
+    frames : iterable of ndarray
+        Frames sampled at 3hz, of any size, see video_source
+
+    velocities : iterable of ndarray
+        Velocity at each frame
+
+    resize_backend : string
+        Resize backend the training data was packaged with
+
+    Yields
+    ------
+    t : integer
+        Index of the last frame of the window, the prediction is for the frame after it
+
+    logits : ndarray
+        Logits of the 4 actions
+
+    '''
+
+    T = predictor.window_length
+    resized = np.empty((1, 244, 244, 3), dtype=np.uint8)
+    ring_features = None
+    ring_velocities = np.empty((T, 2), dtype=np.float32)
+
+    for t, (frame, velocity) in enumerate(zip(frames, velocities)):
+        _resize(frame, backend=resize_backend, out=resized[0])
+        features = predictor.features(resized)
+        if ring_features is None:
+            ring_features = np.empty((T, *features.shape[1:]), dtype=features.dtype)
+
+        # overwrite the oldest frame
+        slot = t % T
+        ring_features[slot] = features[0]
+        ring_velocities[slot] = velocity
+        if t + 1 < T:
+            continue
+
+        # window in the order of training, most recent frame first
+        order = (slot - np.arange(T)) % T
+        yield t, predictor.actions_from_features(ring_features[order], ring_velocities[order])
+
+
+def video_source(video_path, info_path=None):
+    '''
+    Function to sample a video and its info as package_data does
+
+    Parameters
+    ----------
+    video_path : string
+        Path to the video
+
+    info_path : string
+        Path to the JSON info of the video, velocities are zero if None
+
+    Returns
+    -------
+    frames : generator of ndarray
+        Frames kept at the 3hz refresh rate, only valid until the next frame is requested
+
+    velocities : ndarray
+        Velocity at each kept frame, None if the info is not valid
+
+    '''
+
+    video = cv2.VideoCapture(str(video_path))
+    if not video.isOpened():
+        print("Error: could not open video", video_path)
+        return None, None
+
+    # set refresh rate to 3hz
+    hz = int(np.rint(video.get(cv2.CAP_PROP_FPS))) / 3
+    num_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    if info_path is None:
+        velocities = np.zeros((len(range(0, num_frames, 10)), 2), dtype=np.float32)
+    else:
+        record = parse_info(info_path)
+        if not record['valid']:
+            print("Error: invalid info {}: {}".format(info_path, record['reason']))
+            return None, None
+        velocities = frame_velocity(record['timestamp'], record['speed'], record['course'],
+                                    record['startTime'], num_frames, hz)
+
+    def frames():
+        for frame in _sample_frames(video, num_frames, hz):
+            yield frame
+        video.release()
+
+    return frames(), velocities
+
+
+def main(config):
+    """The main function."""
+
+    # Predict the actions of a video with the exported graph
+    if config.stream:
+        frames, velocities = video_source(config.stream, config.stream_info or None)
+        if frames is None:
+            exit(1)
+        predictor = Predictor(config.export_dir)
+        for t, logits in stream(predictor, frames, velocities, config.resize_backend):
+            print("frame {}: action {} logits {}".format(t + 1, np.argmax(logits), np.round(logits, 3)))
+        predictor.close()
+        return
+
+    if export(config) is None:
+        exit(1)
+
+
+if __name__ == "__main__":
+
+    # Parse configuration
+    config, unparsed = get_config()
+    # If we have unparsed arguments, print usage and exit
+    if len(unparsed) > 0:
+        print_usage()
+        exit(1)
+
+    main(config)
@@ -12,6 +12,10 @@ def fcl(x, num_in, num_out, name):
                                   trainable=False)
         biases = tf.get_variable('biases', [num_out], trainable=False)
 
+        # Compute in the dtype of the input, variables stay float32
+        weights = tf.cast(weights, x.dtype)
+        biases = tf.cast(biases, x.dtype)
+
         # Matrix multiply weights and inputs and add bias
         act = tf.nn.xw_plus_b(x, weights, biases, name=scope.name)
 
@@ -19,7 +23,7 @@ def fcl(x, num_in, num_out, name):
     return relu
 
 def convl(x, filter_height, filter_width, num_filters, stride_y, stride_x, name,
-         padding='SAME', groups=1):
+         padding='SAME', groups=1, trainable=True):
     # Get number of input channels
     input_channels = int(x.get_shape()[-1])
 
@@ -33,8 +37,13 @@ def convl(x, filter_height, filter_width, num_filters, stride_y, stride_x, name,
         weights = tf.get_variable('weights', shape=[filter_height,
                                                     filter_width,
                                                     input_channels/groups,
-                                                    num_filters])
-        biases = tf.get_variable('biases', shape=[num_filters])
+                                                    num_filters],
+                                  trainable=trainable)
+        biases = tf.get_variable('biases', shape=[num_filters], trainable=trainable)
+
+    # Compute in the dtype of the input, variables stay float32
+    weights = tf.cast(weights, x.dtype)
+    biases = tf.cast(biases, x.dtype)
     
     if groups == 1:
         conv = convolve(x, weights)
@@ -3,20 +3,45 @@
 # released under MIT license
 # Modified by Austin Hendy, Daria Sova, Maxwell Borden, and Jordan Patterson
 
-import os, h5py, IPython
+import os, copy, IPython
 import numpy as np
+from pathlib import Path
 import tensorflow as tf
 from tqdm import trange
 
 from config import get_config, print_usage
+from utils.checkData import check_data
+from utils.dataLoader import VideoData, MemmapData, BatchLoader, export_memmap, memmap_current, input_stats
+from utils.featureCache import FeatureCache, FeatureSplit, precompute_features
 from utils.preprocessing import package_data
-from utils.segmentation import segmentation_color
+from utils.segmentation import segmentation_color_tf
 from layerutils import fcl, convl
+from weightutils import WeightLoader, convert_weights, load_weights
 
 class Network:
-    def __init__(self, x_shp, lstm_x_shp, config, speed_x_shp):
+
+    # Types and names of the inputs, in the order of a batch
+    _input_dtypes = [tf.float32, tf.int64, tf.float32, tf.int64, tf.float32, tf.int64]
+    _input_names = ["seg_x_in", "seg_y_in", "lstm_x_in", "lstm_y_in", "lstm_speed_x", "lstm_speed_y"]
+    # Inputs are normalized by the training mean and this range
+    input_range = 128.0
+
+    def __init__(self, x_shp, lstm_x_shp, config, speed_x_shp, train_data=None, training=True):
 
         self.config = config
+        # Training split for the tf.data input pipeline, None to feed batches
+        self.train_data = train_data
+        # Loader of the training batches, started before any session
+        self.loader = None
+        # Checkpoint to resume training from, and its step, the index of the next batch
+        self.resume = tf.train.latest_checkpoint(config.log_dir) if training else None
+        self.start = int(tf.train.load_variable(self.resume, "Optim/global_step")) if self.resume else 0
+        # Inference graphs have no dropout, loss, optimizer, summaries or writers
+        self.training = training
+        # Compute dtype of AlexNet
+        self.dtype = tf.float16 if config.precision == "float16" else tf.float32
+        # Cached features are only valid for the pretrained tower, so it is frozen
+        self.train_tower = not config.feature_cache
 
         # Get shape
         self.x_shp = x_shp
@@ -26,11 +51,17 @@ class Network:
         self._build_placeholder()
         self._build_preprocessing()
         self._build_model()
+        if not self.training:
+            self._build_eval()
+            self.saver_best = tf.train.Saver()
+            return
         self._build_loss()
         self._build_optim()
         self._build_eval()
         self._build_summary()
         self._build_writer()
+        # Assign ops for the pretrained weights
+        self.weight_loader = WeightLoader("Network")
 
     def _build_writer(self):
         """Build writers and savers for the model"""
@@ -55,6 +86,8 @@ class Network:
 
         # Merge all the summary op
         self.summary_op = tf.summary.merge_all()
+        # Image summaries are merged separately, to be written less often
+        self.image_summary_op = tf.summary.merge_all(key="image_summaries")
 
     def _build_placeholder(self):
         """Build placeholders."""
@@ -64,15 +97,42 @@ class Network:
         lstm_x_in_shp = (None, *self.lstm_x_shp[1:])
         speed_x_shp = (None, *self.speed_x_shp[1:])
         print("Shapes ", lstm_x_in_shp, speed_x_shp)
-        # Create Placeholders for inputs
-        self.seg_x = tf.placeholder(tf.float32, shape=x_in_shp, name="seg_x_in")
-        self.seg_y = tf.placeholder(tf.int64, shape=x_in_shp[:-1], name="seg_y_in")
-        
-        self.lstm_x = tf.placeholder(tf.float32, shape=lstm_x_in_shp, name="lstm_x_in")
-        self.lstm_y = tf.placeholder(tf.int64, shape=x_in_shp[:-1], name="lstm_y_in")
-        
-        self.lstm_speed_x = tf.placeholder(tf.float32, shape=speed_x_shp, name="lstm_speed_x")
-        self.lstm_speed_y = tf.placeholder(tf.int64, shape=speed_x_shp[0], name="lstm_speed_y")
+        shapes = [x_in_shp, x_in_shp[:-1], lstm_x_in_shp, x_in_shp[:-1], speed_x_shp, speed_x_shp[0]]
+
+        if self.train_data is None:
+            # Create Placeholders for inputs
+            inputs = [tf.placeholder(dtype, shape=shape, name=name) for dtype, shape, name in zip(
+                self._input_dtypes, shapes, self._input_names)]
+        else:
+            # Placeholders default to the next training batch, and can still be fed (e.g. validation)
+            batch = self._build_dataset().make_one_shot_iterator().get_next()
+            inputs = [tf.placeholder_with_default(tensor, shape=shape, name=name) for tensor, shape, name in zip(
+                batch, shapes, self._input_names)]
+
+        self.seg_x, self.seg_y, self.lstm_x, self.lstm_y, self.lstm_speed_x, self.lstm_speed_y = inputs
+
+    def _build_dataset(self):
+        """Build the tf.data input pipeline over the training split."""
+
+        data = self.train_data
+        batch_size = self.config.batch_size
+        sample = data.batch([0])
+        # Random batches, drawn with replacement as in feed mode. Workers are forked here, before
+        # TensorFlow starts its threads, and batches are copied as prefetch keeps them
+        self.loader = BatchLoader(data, batch_size, self.config.loader_workers, self.config.seed,
+                                  start=self.start, copy=True)
+
+        def batches():
+            yield from self.loader
+
+        # Batches are assembled by a background thread, and kept ahead of training by prefetch
+        dataset = tf.data.Dataset.from_generator(
+            batches,
+            output_types=tuple(tf.as_dtype(x.dtype) for x in sample),
+            output_shapes=tuple((None, *x.shape[1:]) for x in sample))
+        dataset = dataset.map(
+            lambda *batch: tuple(tf.cast(x, dtype) for x, dtype in zip(batch, self._input_dtypes)))
+        return dataset.prefetch(self.config.prefetch)
  
     def _build_preprocessing(self):
         """Build preprocessing related graph."""
@@ -105,8 +165,17 @@ class Network:
                 trainable=False)
             optimizer = tf.train.AdamOptimizer(
                 learning_rate=self.config.learning_rate)
-            self.optim = optimizer.minimize(
-                self.loss, global_step=self.global_step)
+            if self.config.precision == "float16":
+                # Scale the loss so small float16 gradients do not underflow,
+                # and unscale the float32 gradients before updating the weights
+                scale = self.config.loss_scale
+                grads_and_vars = optimizer.compute_gradients(self.loss * scale)
+                self.optim = optimizer.apply_gradients(
+                    [(grad / scale, var) for grad, var in grads_and_vars if grad is not None],
+                    global_step=self.global_step)
+            else:
+                self.optim = optimizer.minimize(
+                    self.loss, global_step=self.global_step)
 
     def _build_eval(self):
         """Build the evaluation related ops"""
@@ -114,14 +183,16 @@ class Network:
         with tf.variable_scope("Eval", tf.AUTO_REUSE):
 
             # Compute the accuracy of the Segmentation.
-            self.seg_pred = tf.argmax(self.seg_logits, axis=3) # Argmax per pixel
-            self.segmentation_frame = tf.py_func(segmentation_color, [self.seg_pred], [tf.uint8])[0]
-            tf.summary.image('segmentation!', self.segmentation_frame)
+            self.seg_pred = tf.argmax(self.seg_logits, axis=3, name="seg_pred") # Argmax per pixel
+            self.segmentation_frame = segmentation_color_tf(self.seg_pred)
+            tf.summary.image('segmentation!', self.segmentation_frame,
+                             collections=["image_summaries"])
             self.seg_acc = tf.reduce_mean( 
                 tf.to_float(tf.equal(self.seg_pred, self.seg_y))
             )
 
             # TODO: accuracy for LSTM
+            self.lstm_logits = tf.identity(self.lstm_out, name="lstm_logits")
             self.lstm_pred = tf.argmax(self.lstm_out, axis=1)
             self.lstm_acc = tf.reduce_mean( 
                 tf.to_float(tf.equal(self.lstm_pred, self.lstm_speed_y))
@@ -142,37 +213,17 @@ class Network:
         '''
         Load weights from a file into network.
         Weights taken from http://www.cs.toronto.edu/~guerzhoy/tf_alexnet/
-        It is a dict of lists 
+        It is a dict of lists, converted once to one memory-mapped file per variable
         '''
 
         print("Loading pretrained weights for Alexnet...")
-        # load weights from the file
-        weights_dict = np.load(self.config.weights_dir, encoding='bytes').item()
-        # Loop over all layer names stored in the weights dict
         # dict_keys(['fc6', 'fc7', 'fc8', 'conv3', 'conv2', 'conv1', 'conv5', 'conv4'])
-        for op_name in weights_dict:
-
-            with tf.variable_scope("Network", reuse=True):
-
-                with tf.variable_scope(op_name, reuse=True):
-                    try:
-                        weights, biases = weights_dict[op_name]
-
-                        # Load Weights
-                        if op_name == 'fc6':
-                            weights = tf.reshape(weights, (6, 6, 256, 4096))
-                        elif op_name == 'fc7':
-                            weights = tf.reshape(weights, (1, 1, 4096, 4096))
-                        var = tf.get_variable('weights', trainable=False)
-                        sess.run(var.assign(weights))
-
-                        # Load Biases
-                        var = tf.get_variable('biases', trainable=False)
-                        sess.run(var.assign(biases))
-                        print("Loading: ", op_name)
-                    except:
-                        pass
-                            
+        weights = load_weights(convert_weights(self.config.weights_dir))
+        loaded = self.weight_loader.load(sess, weights)
+        print("Loaded: ", ", ".join(loaded))
+        skipped = sorted({name.split('/')[0] for name in weights} - set(loaded))
+        if skipped:
+            print("Not used by the network: ", ", ".join(skipped))
         print("Weights loaded.")
 
 
@@ -186,43 +237,46 @@ class Network:
         
         # Normalize using the above training-time statistics
         cur_in = (x_in - self.n_mean) / self.n_range
+        # Compute the tower in float16 if requested, variables stay float32
+        cur_in = tf.cast(cur_in, self.dtype)
         print("Starting shape...", cur_in.shape)
+        trainable = self.train_tower
 
         # 1st Layer Conv1
-        cur_in = convl(cur_in, 11, 11, 96, 4, 4, padding='VALID', name='conv1')
+        cur_in = convl(cur_in, 11, 11, 96, 4, 4, padding='VALID', name='conv1', trainable=trainable)
         cur_in = tf.contrib.layers.max_pool2d(cur_in, [3, 3], 2, padding='VALID')
 
         # 2nd Layer Conv2
-        cur_in = convl(cur_in, 5, 5, 256, 1, 1, groups=2, name='conv2')
+        cur_in = convl(cur_in, 5, 5, 256, 1, 1, groups=2, name='conv2', trainable=trainable)
         cur_in = tf.contrib.layers.max_pool2d(cur_in, [3, 3], 2, padding='VALID')
 
         # 3rd Layer Conv3
-        cur_in = convl(cur_in, 3, 3, 384, 1, 1, name='conv3')
+        cur_in = convl(cur_in, 3, 3, 384, 1, 1, name='conv3', trainable=trainable)
 
         # 4th Layer Conv4
-        cur_in = convl(cur_in, 3, 3, 384, 1, 1, groups=2, name='conv4')
+        cur_in = convl(cur_in, 3, 3, 384, 1, 1, groups=2, name='conv4', trainable=trainable)
 
         # 5th Layer Conv5
-        cur_in = convl(cur_in, 3, 3, 256, 1, 1, groups=2, name='conv5')
+        cur_in = convl(cur_in, 3, 3, 256, 1, 1, groups=2, name='conv5', trainable=trainable)
         
         cur_in = tf.contrib.layers.dropout(cur_in,
-                                    0.3, is_training=True)
+                                    0.3, is_training=self.training)
 
         # Fully connected layers with conv
-        cur_in = convl(cur_in, 6, 6, 4096, 1, 1,  padding='VALID', name='fc6')
+        cur_in = convl(cur_in, 6, 6, 4096, 1, 1,  padding='VALID', name='fc6', trainable=trainable)
 
-        cur_in = tf.contrib.layers.dropout(cur_in, 0.3, is_training=True)
+        cur_in = tf.contrib.layers.dropout(cur_in, 0.3, is_training=self.training)
 
         # 8th Layer: FC (w ReLu) -> Dropout (as conv layer)
-        cur_in = convl(cur_in, 1, 1, 4096, 1, 1,  padding='VALID', name='fc7')
+        cur_in = convl(cur_in, 1, 1, 4096, 1, 1,  padding='VALID', name='fc7', trainable=trainable)
 
-        cur_in = tf.contrib.layers.dropout(cur_in, 0.3, is_training=True)
+        cur_in = tf.contrib.layers.dropout(cur_in, 0.3, is_training=self.training)
         print("Starting shape...", cur_in.shape)
 
         # 8th Layer: FC and return unscaled activations
         # cur_in = fcl(cur_in, 4096, self.config.num_class, name='fc8')
         print("AlexNet Done.")
-        return cur_in
+        return tf.cast(cur_in, tf.float32)
 
     def _build_model(self):
         """Build Network."""
@@ -233,13 +287,26 @@ class Network:
             yshps = [x.value for x in self.seg_y.get_shape()]
             lstm_x_shps = [x.value for x in self.lstm_x.get_shape()]
 
-            alex_in = tf.reshape(self.lstm_x, (
-                -1, self.lstm_x_shp[2], self.lstm_x_shp[3], self.lstm_x_shp[4])
+            alex_in = self.lstm_frames = tf.reshape(self.lstm_x, (
+                -1, self.lstm_x_shp[2], self.lstm_x_shp[3], self.lstm_x_shp[4]),
+                name="lstm_frames"
             )
             print("Alex_in shape..", alex_in.shape)
  
+            if self.config.feature_cache:
+                # the LSTM head runs on fed features, the LSTM frames do not go through AlexNet
+                cur_in_seg = self.alexNet(self.seg_x)
+                cur_in_lstm = None
+            elif self.config.share_tower:
+                # run segmentation and LSTM frames through AlexNet as one batch, and split the features
+                num_seg = tf.shape(self.seg_x)[0]
+                features = self.alexNet(tf.concat([self.seg_x, alex_in], axis=0))
+                cur_in_seg, cur_in_lstm = features[:num_seg], features[num_seg:]
+            else:
+                cur_in_seg = self.alexNet(self.seg_x)
+                cur_in_lstm = self.alexNet(alex_in)
+
             # reshape Segmentation output to N classes final dim
-            cur_in_seg = self.alexNet(self.seg_x)
             classwise_seg_preds = tf.contrib.layers.conv2d(cur_in_seg, self.config.num_class, [1, 1],
                                    activation_fn=None,
                                    padding="VALID",
@@ -258,14 +325,20 @@ class Network:
 
             #### #### LSTM #### ####
             lstm_x_shps = [x.value for x in self.lstm_x.get_shape()]
-            cur_in_lstm = self.alexNet(alex_in)
             # cur_in_lstm = tf.contrib.layers.conv2d(cur_in_lstm, 2, [1, 1],
             #                        activation_fn=None,
             #                        padding="VALID",
             #                        biases_initializer=None)
             
             # cur_in_lstm = tf.contrib.layers.max_pool2d(cur_in_lstm, [4, 4], 3, padding='VALID')
-            cur_in_lstm = tf.reshape(cur_in_lstm, [tf.shape(self.lstm_speed_y)[0], lstm_x_shps[1], -1])
+            # AlexNet features of every LSTM frame, can be fed to reuse features of earlier frames
+            if cur_in_lstm is None:
+                # features of the frames have the shape of those of the segmentation input
+                cur_in_lstm = self.lstm_features = tf.placeholder(
+                    tf.float32, shape=(None, *cur_in_seg.shape[1:]), name="lstm_features")
+            else:
+                cur_in_lstm = self.lstm_features = tf.identity(cur_in_lstm, name="lstm_features")
+            cur_in_lstm = tf.reshape(cur_in_lstm, [-1, lstm_x_shps[1], int(np.prod(cur_in_lstm.shape[1:]))])
 
             # put speed data together
             # lstm input should be (N, T, D) shape
@@ -303,56 +376,47 @@ class Network:
         return activ
 
 
-    def train(self, seg_data, lstm_data, speed_data):
+    def train(self, data_tr, data_va):
         """Training function.
 
         Parameters
         ----------
-        seg_data : tuple of ndarray
-            Training data.
-            Training labels.
-            Validation data.
-            Validation labels.
-
-        lstm_data : tuple of ndarray
-            Training data.
-            Training labels.
-            Validation data.
-            Validation labels.
-
-        speed_data : tuple ndarray
-            Training data.
-            Training labels.
-            Validation data.
-            Validation labels.
-        """
+        data_tr : VideoSplit
+            Training data and labels, read one batch at a time.
 
-        # Unpack
-        seg_x, seg_y, seg_x_va, seg_y_va = seg_data
-        lstm_x, lstm_y, lstm_x_va, lstm_y_va = lstm_data
-        speed_x, speed_y, speed_x_va, speed_y_va = speed_data
+        data_va : VideoSplit
+            Validation data and labels, read one batch at a time.
+        """
 
         # ----------------------------------------
         # Preprocess data
-        x_tr_mean = seg_x.mean()
-        x_tr_range = 128.0
+        x_tr_mean, x_tr_std, x_tr_min, x_tr_max = input_stats(data_tr)
+        x_tr_range = self.input_range
 
         # Report data statistic
         print("Training data before: mean {}, std {}, min {}, max {}".format(
-            x_tr_mean, seg_x.std(), seg_x.min(), seg_x.max()
+            x_tr_mean, x_tr_std, x_tr_min, x_tr_max
         ))
 
+        # Check if previous train exists
+        b_resume = self.resume
+
+        # Random training batches, resuming from the saved step. Workers are forked
+        # before the session, so they do not inherit TensorFlow's threads
+        if self.train_data is None:
+            self.loader = BatchLoader(data_tr, self.config.batch_size, self.config.loader_workers,
+                                      self.config.seed, start=self.start)
 
-        
         # ----------------------------------------
         # Run TensorFlow Session
         with tf.Session() as sess:
             
-            self._load_initial_weights(sess)
             tf.keras.backend.set_session(sess)
             # Init
             print("Initializing...")
             sess.run(tf.global_variables_initializer())
+            # Pretrained weights replace the initial values
+            self._load_initial_weights(sess)
 
             # Assign normalization variables from statistics of the train data
             sess.run(self.n_assign_op, feed_dict={
@@ -360,9 +424,6 @@ class Network:
                 self.n_range_in: x_tr_range,
             })
 
-            # Check if previous train exists
-            b_resume = tf.train.latest_checkpoint(self.config.log_dir)
-
             if b_resume:
                 # Restore network from log_dir for curr model
                 print("Restoring from {}...".format(
@@ -384,20 +445,18 @@ class Network:
                 best_acc = 0
 
             print("Training...")
-            batch_size = config.batch_size
-            max_iter = config.max_iter
+            batch_size = self.config.batch_size
+            max_iter = self.config.max_iter
+            if len(data_va) == 0:
+                print("Warning: no validation windows, validation skipped")
             # For each epoch
             for step in trange(step, max_iter):
 
-                # Get a random training batch
-                ind_cur = np.random.choice(
-                    len(seg_x), batch_size, replace=True)
-                seg_x_b = np.array([seg_x[_i] for _i in ind_cur])
-                seg_y_b = np.array([seg_y[_i] for _i in ind_cur])
-                lstm_x_b = np.array([lstm_x[_i] for _i in ind_cur])
-                lstm_y_b = np.array([lstm_y[_i] for _i in ind_cur])
-                speed_x_b =  np.array([speed_x[_i] for _i in ind_cur])
-                speed_y_b =  np.array([speed_y[_i] for _i in ind_cur])
+                # Batches come from the input pipeline if there is one
+                feed_dict = None
+                if self.train_data is None:
+                    # Get a random training batch, reading only its samples
+                    feed_dict = dict(zip(self._inputs(), next(self.loader)))
 
                 # Write summary every N iterations as well as the first iteration
                 K = self.config.report_freq
@@ -413,17 +472,17 @@ class Network:
                         "optim": self.optim,
                     }
 
+                # Write image summary on its own, less frequent schedule
+                I = self.config.image_freq
+                b_write_image = I > 0 and (step % I == 0 and step != 0 or step == 1)
+                if b_write_image:
+                    fetches["image_summary"] = self.image_summary_op
+                    fetches["global_step"] = self.global_step
+
                 # Run the operations necessary for training
                 res = sess.run(
                     fetches=fetches,
-                    feed_dict={
-                        self.seg_x: seg_x_b,
-                        self.seg_y: seg_y_b,
-                        self.lstm_x: lstm_x_b,
-                        self.lstm_y: lstm_y_b,
-                        self.lstm_speed_x: speed_x_b,
-                        self.lstm_speed_y: speed_y_b,
-                    },
+                    feed_dict=feed_dict,
                 )
 
                # Write Training Summary if we fetched it (no meta graph)
@@ -440,28 +499,43 @@ class Network:
                        write_meta_graph=False,
                    )
 
+                if "image_summary" in res:
+                    self.summary_tr.add_summary(
+                        res["image_summary"], global_step=res["global_step"],
+                    )
+                    self.summary_tr.flush()
+
                 # Validate every N iterations and at the first iteration.
                 V = self.config.val_freq
-                b_validate = step % V == 0 and step != 0 or step == 1
+                b_validate = (step % V == 0 and step != 0 or step == 1) and len(data_va) > 0
                 if b_validate:
-                    res = sess.run(
-                        fetches={
-                           "acc": self.seg_acc,
-                           "summary": self.summary_op,
-                           "global_step": self.global_step,
-                        },
-                        feed_dict={
-                            self.seg_x: seg_x_va,
-                            self.seg_y: seg_y_va,
-                            self.lstm_x: lstm_x_va,
-                            self.lstm_y: lstm_y_va,
-                            self.lstm_speed_x: speed_x_va,
-                            self.lstm_speed_y: speed_y_va,
-                        })
+                    # Validate one batch at a time, summaries are of the first batch
+                    res = None
+                    acc = []
+                    for ind_va in np.array_split(np.arange(len(data_va)), max(len(data_va) // batch_size, 1)):
+                        fetches = {"acc": self.seg_acc}
+                        if res is None:
+                            fetches.update({
+                                "summary": self.summary_op,
+                                "global_step": self.global_step,
+                            })
+                            # image summaries are disabled for validation as for training
+                            if self.config.image_freq > 0:
+                                fetches["image_summary"] = self.image_summary_op
+                        res_cur = sess.run(
+                            fetches=fetches,
+                            feed_dict=dict(zip(self._inputs(), data_va.batch(ind_va))))
+                        res = res or res_cur
+                        acc.append(res_cur["acc"] * len(ind_va))
+                    res["acc"] = np.sum(acc) / len(data_va)
                     # Write Validation Summary
                     self.summary_va.add_summary(
                        res["summary"], global_step=res["global_step"],
                     )
+                    if "image_summary" in res:
+                        self.summary_va.add_summary(
+                            res["image_summary"], global_step=res["global_step"],
+                        )
                     self.summary_va.flush()
 
                     # If best validation accuracy, update W_best, b_best, and best accuracy
@@ -478,7 +552,9 @@ class Network:
                            write_meta_graph=False,
                        )
 
-    def test(self, x_te, y_te):
+            self.loader.close()
+
+    def test(self, data_te):
         """Test function"""
         with tf.Session() as sess:
             # Load the best model
@@ -492,20 +568,34 @@ class Network:
                     latest_checkpoint
                 )
 
-            # Test on the test data
-            res = sess.run(
-                fetches={
-                    "seg_acc": self.seg_acc,
-                },
-                feed_dict={
-                    self.seg_x: x_te,
-                    self.seg_y: y_te,
-                },
-            )
+            if len(data_te) == 0:
+                print("Error: no test windows")
+                return
+            # the LSTM head is built on features, so they must be fed in place of the frames
+            if self.config.feature_cache and not isinstance(data_te, FeatureSplit):
+                print("Error: test split has no cached features, wrap it in a FeatureSplit")
+                return
+
+            # Test on the test data, one batch at a time
+            acc = []
+            for ind_te in np.array_split(np.arange(len(data_te)), max(len(data_te) // self.config.batch_size, 1)):
+                res = sess.run(
+                    fetches={
+                        "seg_acc": self.seg_acc,
+                    },
+                    feed_dict=dict(zip(self._inputs(), data_te.batch(ind_te))),
+                )
+                acc.append(res["seg_acc"] * len(ind_te))
 
             # Report (print) test result
             print("Test accuracy with the best model is {}".format(
-                res["seg_acc"]))
+                np.sum(acc) / len(data_te)))
+
+    def _inputs(self):
+        """Input placeholders, in the order of a batch"""
+        # cached features are fed in place of the LSTM frames, so the LSTM tower does not run
+        lstm_x = self.lstm_features if self.config.feature_cache else self.lstm_x
+        return [self.seg_x, self.seg_y, lstm_x, self.lstm_y, self.lstm_speed_x, self.lstm_speed_y]
 
 
     def _build_loss(self):
@@ -553,130 +643,123 @@ class Network:
             tf.summary.scalar("loss", self.loss)
 
 
+class PretrainedTower:
+    '''
+    AlexNet tower with the pretrained weights, as frozen by --feature_cache, in its own session
+
+    Features are computed without dropout and normalized as Network.train does, so they are the
+    features the frozen tower computes for the same frames
+
+    Parameters
+    ----------
+    config : argparse.Namespace
+        Configuration, see config.py
+
+    x_shp, lstm_x_shp, speed_x_shp : tuple
+        Shapes of the inputs, see Network
+
+    mean : float
+        Mean of the training segmentation inputs, see input_stats
+
+    '''
+
+    def __init__(self, config, x_shp, lstm_x_shp, speed_x_shp, mean):
+        # the tower of Network, with LSTM frames run through it
+        tower_config = copy.copy(config)
+        tower_config.feature_cache = ""
+        tower_config.share_tower = False
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            net = Network(x_shp, lstm_x_shp, tower_config, speed_x_shp, training=False)
+            weight_loader = WeightLoader("Network")
+            self.sess = tf.Session(graph=self.graph)
+            self.sess.run(tf.global_variables_initializer())
+            self.sess.run(net.n_assign_op, feed_dict={net.n_mean_in: mean, net.n_range_in: net.input_range})
+            weight_loader.load(self.sess, load_weights(convert_weights(config.weights_dir)))
+        self._features = self.sess.make_callable(net.lstm_features, feed_list=[net.lstm_frames])
+
+    def features(self, frames):
+        """AlexNet features of a (N, 244, 244, 3) batch of frames"""
+        return self._features(np.asarray(frames, dtype=np.float32))
+
+    def close(self):
+        self.sess.close()
+
+
 def main(config):
     """The main function."""
 
     # Package data from directory into HD5 format
+    # only new or modified videos are packaged unless --repackage is set
     if config.package_data:
         print("Packaging data into H5 format...")
-        package_data(config.data_dir)
+        package_data(config.data_dir, workers=config.package_workers,
+                     resize_backend=config.resize_backend, force=config.repackage,
+                     chunked=config.h5_chunked, compression=config.h5_compression,
+                     shuffle=config.h5_shuffle, seed=config.seed)
     else:
         print("Packaging data skipped.")
 
-    # Load packaged data
+    # Load packaged data, samples are read from the file as batches need them
     print("Loading data...")
-    f = h5py.File('videoData.h5', 'r')
-    data = []
-    for group in f:
-        """
-        Keys of groups:
-        ['class_colour',
-         'class_id',
-         'frame-10s',
-         'info',
-         'instance_colour',
-         'instance_id',
-         'raw_images',
-         'video']
-        """
-        data.append(f[group])
-
-    num_videos = len(data)
-
-    # frame data and labels
-    x = []
-    y = []
-
-    # contains previous frames
-    lstm_x = []
-    lstm_y = []
-
-    # speed data and labels
-    speed_x = []
-    speed_y = []
-
-    # iterate through videos
-    for row in data:
-        video = row.get('video')
-        if not video: continue
-        vector = row['info']
-        assert video.shape[0] == vector.shape[0] 
-
-        x.append(row['frame-10s'][:]) # Segmentation x, y
-        y.append(row['class_id'][:])
-
-        # current frame is the 30th so we want to also consider several previous ones
-        batch = [video[29], video[28]]
-        lstm_x.append(batch)
-        lstm_y.append(row['frame-10s'][:])
-
-        # motion data for lstm
-        speed_batch = [vector[29], vector[28]]
-        speed_x.append(speed_batch)
-        speed_y.append(vector[30])
-
-
-    # convert to np arrays
-    x = np.asarray(x)
-    y = np.asarray(y)
-    lstm_x = np.asarray(lstm_x)
-    lstm_y = np.asarray(lstm_y)
-    speed_x = np.asarray(speed_x)
-    speed_y = np.asarray(speed_y)
-
-    print('Segmentation input shape: ', x.shape)
-    print('LSTM X input shape: ', lstm_x.shape)
-    print('Speed data input shape: ', speed_x.shape)
-    
-    assert len(x.shape) == 4, "Required: X is 4 tensor got %d." % len(x.shape)
-    assert len(y.shape) == 4, "Required Y is 4 tensor got %d." % len(y.shape)
-    assert len(lstm_x.shape) == 5, "Required: X is 5 tensor got %d." % len(lstm_x.shape)
-
+    # order videos as in the shuffled sample index, falling back to H5 order without the data directory
+    index = check_data(Path(config.data_dir), config.seed)
+    if config.data_format == "memmap":
+        # export flat arrays when the packaged videos changed since the last export
+        if not memmap_current('videoData.h5', config.memmap_dir):
+            print("Exporting data to {}...".format(config.memmap_dir))
+            export_memmap('videoData.h5', config.memmap_dir)
+        data_class, data_path = MemmapData, config.memmap_dir
+    else:
+        data_class, data_path = VideoData, 'videoData.h5'
+    data = data_class(data_path, names=index.names if index is not None else None,
+                      window_length=config.window_length, window_stride=config.window_stride,
+                      window_end=config.window_end)
 
-    # Each label is pixel of [class_id, class_id, class_id], convert to single value
-    y = y[:, :, :, 0]
-    lstm_y = lstm_y[:, :, :, 0]
-    
-    def split(data):
-        # 70% train, 20% val, 10% test split
-        train_split = int(num_videos * 0.7)
-        val_split = int(num_videos * 0.2) + train_split
-        return data[:train_split], data[train_split:val_split], data[val_split:]
-    
-    # Seg data
-    x_tr, x_va, x_te = split(x)
-    y_tr, y_va, y_te = split(y)
-    
-    # LSTM Alexnet data
-    lstm_x_tr, lstm_x_va, lstm_x_te = split(lstm_x)
-    lstm_y_tr, lstm_y_va, lstm_y_te = split(lstm_y)
-    
-    # Motion data
-    speed_y = np.apply_along_axis(_course_speed_labeler, -1, speed_y)
-    speed_x_tr, speed_x_va, speed_x_te = split(speed_x)
-    speed_y_tr, speed_y_va, speed_y_te = split(speed_y)
-    
-    seg_data = x_tr, y_tr, x_va, y_va
-    lstm_data = lstm_x_tr, lstm_y_tr, lstm_x_va, lstm_y_va 
-    speed_data = speed_x_tr, speed_y_tr, speed_x_va, speed_y_va
+    if len(data.train) == 0:
+        print("Error: no training windows in", data_path)
+        exit(1)
 
-    # build network
-    net = Network(x_tr.shape, lstm_x_tr.shape, config, speed_x_tr.shape)
+    # shapes of the training split
+    x_shp, y_shp, lstm_x_shp, lstm_y_shp, speed_x_shp, speed_y_shp = data.train.shapes
+
+    print('Segmentation input shape: ', x_shp)
+    print('LSTM X input shape: ', lstm_x_shp)
+    print('Speed data input shape: ', speed_x_shp)
+
+    assert len(x_shp) == 4, "Required: X is 4 tensor got %d." % len(x_shp)
+    assert len(y_shp) == 3, "Required Y is 3 tensor got %d." % len(y_shp)
+    assert len(lstm_x_shp) == 5, "Required: X is 5 tensor got %d." % len(lstm_x_shp)
+
+    data_tr, data_va, data_te = data.train, data.val, data.test
+    # train the LSTM branch on features of the frozen pretrained tower, computed once per frame
+    if config.feature_cache:
+        # features depend on the weights, the normalization and the precision of the tower
+        mean = input_stats(data.train)[0]
+        tower = PretrainedTower(config, x_shp, lstm_x_shp, speed_x_shp, mean)
+        precompute_features(config.feature_cache, data, tower.features, "{} {} mean {} {}".format(
+            config.weights_dir, os.path.getmtime(config.weights_dir), mean, config.precision))
+        tower.close()
+
+        cache = FeatureCache(config.feature_cache, config.feature_cache_size)
+        data_tr, data_va, data_te = [FeatureSplit(split, cache) for split in [data.train, data.val, data.test]]
+        # features are fed to the LSTM head, which has no tower to share and needs feed mode
+        if config.share_tower or config.input_pipeline == "dataset":
+            print("Warning: feature cache uses separate towers and feed mode")
+            config.share_tower = False
+            config.input_pipeline = "feed"
+
+    # build network, with the tf.data input pipeline over the training split if requested
+    train_data = None
+    if config.input_pipeline == "dataset":
+        train_data = data_tr
+    net = Network(x_shp, lstm_x_shp, config, speed_x_shp, train_data=train_data)
     # train on train/val data
-    net.train(seg_data, lstm_data, speed_data)
+    net.train(data_tr, data_va)
     
     # test on test data
-    # net.test(x_te, y_te_labels)
-
-def _course_speed_labeler(speed):
-    if speed[0] < 1:
-        return 1
-    if abs(speed[1]) < 6:
-        return 2
-    if speed[1] < 0:
-        return 3
-    else:
-        return 4
+    # net.test(data_te)
 
 if __name__ == "__main__":
 
@@ -1,23 +1,52 @@
 
-import os, glob
+import os
 import numpy as np
 
+from collections import namedtuple
 from pathlib import Path
-from builtins import any
 
 
-def check_data(data_dir):
+# folders holding one file per sample, as (key, folder relative to data_dir, file extension)
+FOLDERS = [
+    ('videos', 'videos', '.mov'),
+    ('info', 'info', '.json'),
+    ('frames', 'frame-10s', '.jpg'),
+    ('class_colour', 'segmentation/class_color', '.png'),
+    ('class_id', 'segmentation/class_id', '.png'),
+    ('instance_colour', 'segmentation/instance_color', '.png'),
+    ('instance_id', 'segmentation/instance_id', '.png'),
+    ('raw_images', 'segmentation/raw_images', '.jpg'),
+]
+
+# result of check_consistency
+# complete: sorted list of names present in every folder
+# missing: dict mapping every other name to the list of folders it is missing from
+ConsistencyReport = namedtuple('ConsistencyReport', ['complete', 'missing'])
+
+
+def check_data(data_dir, seed=None):
     '''
     Author: Jordan Patterson
     
     Function to check all relevant files in "data_dir" to ensure they are valid
 
+    Inconsistent samples are moved to the "debug" folder, and the remaining samples are indexed
+    The index is saved in "data_dir" and reused by later runs while no files are added or removed
+
     Parameters
     ----------
 
     data_dir : PurePath object
         Absolute path to the directory containing folders "videos", "info", "frame-10s" and "segmentation"
 
+    seed : integer
+        Seed used to shuffle the samples, shuffled randomly if None
+
+    Returns
+    -------
+    index : SampleIndex
+        Shuffled index of the valid samples, None if "data_dir" is not valid
+
     '''
     
     # ensure we are searching a valid directory
@@ -25,14 +54,13 @@ def check_data(data_dir):
         print('Error: path to', data_dir, 'does not exist, change data_dir in config.py to a valid directory')
         return
 
-    # get list of segmentation subdirectories
-    subdirectories = os.listdir(data_dir / 'segmentation')
+    # get list of subdirectories
+    subdirectories = os.listdir(data_dir)
     # ensure subdirectories are valid
-    if 'class_color' not in subdirectories or 'class_id' not in subdirectories or 'instance_color' not in subdirectories or 'instance_id' not in subdirectories or 'raw_images' not in subdirectories:
+    if 'videos' not in subdirectories or 'info' not in subdirectories or 'frame-10s' not in subdirectories or 'segmentation' not in subdirectories:
         print('Error: data directory', data_dir, 'does not contain all required folders (videos/info/frame-10s/segmentation)')
         return
 
-
     # get list of segmentation subdirectories
     subdirectories = os.listdir(data_dir / 'segmentation')
     # ensure subdirectories are valid
@@ -40,54 +68,144 @@ def check_data(data_dir):
         print('Error: data directory', data_dir, 'segmentation does not contain all required folders (class_color, class_id, instance_color, instance_id, raw_images)')
         return
 
-    # find paths for data
-    videos = list(data_dir.glob('videos/*.mov'))
-    info = list(data_dir.glob('info/*.json'))
-    frames = list(data_dir.glob('frame-10s/*.jpg'))
-    # find paths for labels
-    class_colour = list(data_dir.glob('segmentation/class_color/*.png'))
-    class_id = list(data_dir.glob('segmentation/class_id/*.png'))
-    instance_colour = list(data_dir.glob('segmentation/instance_color/*.png'))
-    instance_id = list(data_dir.glob('segmentation/instance_id/*.png'))
-    raw_images = list(data_dir.glob('segmentation/raw_images/*.jpg'))
-    # put paths in list
-    data = [videos, info, frames, class_colour, class_id, instance_colour, instance_id, raw_images]
-
-    # check that paths are not empty
-    for path in data:
-        if not path:
-            print('Error: data directory ' + data_dir + ' does not contain data in required format in all folders')
-            return
-
-    # find largest dataset to parse
-    names = max(data, key=len)
-    index = data.index(names)
-
-    # check that dataset is valid
-    for name in range(len(names)):
-        # for each video, get name without extension
-        name = Path(data[index][name]).stem
-        # check if video exists in all paths
-        for d in data:
-            # remove inconsistent videos
-            if not any(name in index.stem for index in d):
-                send_to_debug(data_dir, name)
-                break
-    
-    # create array of random values, where length and range of s = length of datasets
-    s = np.arange(np.asarray(videos).shape[0])
-    np.random.shuffle(s)
-    # shuffle data randomly
-    videos = np.asarray(videos)[s]
-    info = np.asarray(info)[s]
-    frames = np.asarray(frames)[s]
-    class_colour = np.asarray(class_colour)[s]
-    class_id = np.asarray(class_id)[s]
-    instance_colour = np.asarray(instance_colour)[s]
-    instance_id = np.asarray(instance_id)[s]
-    raw_images = np.asarray(raw_images)[s]
-
-    return videos, info, frames, class_colour, class_id, instance_colour, instance_id, raw_images
+    # reuse the saved index if no files were added or removed since it was built
+    index = SampleIndex.load(data_dir)
+    if index is None:
+        index, report = SampleIndex.scan(data_dir)
+
+        # remove inconsistent videos
+        for name in sorted(report.missing):
+            send_to_debug(data_dir, name)
+        if report.missing:
+            print('Warning: {} of {} videos are missing files'.format(len(report.missing), len(report.missing) + len(report.complete)))
+
+        # save after moving files, so the saved folder times are current
+        index.save()
+
+    # check that samples are not empty
+    if len(index) == 0:
+        print('Error: data directory', data_dir, 'does not contain data in required format in all folders')
+        return
+
+    return index.shuffled(seed)
+
+
+class SampleIndex:
+    '''
+    Aligned index of the samples in a data directory
+
+    Every record holds the name of one sample and the path of its file in each of FOLDERS, relative
+    to "data_dir", so the files of a sample can never be misaligned
+
+    '''
+
+    # file the index is saved to in "data_dir"
+    filename = 'sampleIndex.npz'
+
+    def __init__(self, data_dir, records):
+        self.data_dir = Path(data_dir)
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def names(self):
+        """Names of the samples in index order"""
+        return list(self.records['name'])
+
+    def paths(self, i):
+        """Absolute paths of the files of sample i, in FOLDERS order"""
+        return tuple(self.data_dir / self.records[key][i] for key, _, _ in FOLDERS)
+
+    def column(self, key):
+        """Absolute paths of the files in one folder, in index order"""
+        return [self.data_dir / path for path in self.records[key]]
+
+    def subset(self, keep):
+        """Copy of the index with only the samples selected by keep, a boolean mask or indices"""
+        return SampleIndex(self.data_dir, self.records[keep])
+
+    def shuffled(self, seed=None):
+        """Copy of the index in random order, reproducible for a given seed"""
+        return SampleIndex(self.data_dir, self.records[np.random.RandomState(seed).permutation(len(self))])
+
+    @classmethod
+    def scan(cls, data_dir):
+        '''
+        Function to index the complete samples of a data directory, scanning each folder once
+
+        Returns the index, sorted by name, and the ConsistencyReport of the scan
+        '''
+
+        data_dir = Path(data_dir)
+
+        # map the name of every file to its path, for each folder
+        files = {}
+        for key, folder, extension in FOLDERS:
+            with os.scandir(data_dir / folder) as entries:
+                files[key] = {entry.name[:-len(extension)]: folder + '/' + entry.name for entry in entries
+                              if entry.name.endswith(extension) and entry.is_file()}
+
+        report = check_consistency(files)
+
+        # one record per complete sample
+        width = max([len(name) for name in report.complete], default=1)
+        dtype = [('name', 'U{}'.format(width))] + [(key, 'U{}'.format(width + len(folder) + len(extension) + 1)) for key, folder, extension in FOLDERS]
+        records = np.array([(name, *[files[key][name] for key, _, _ in FOLDERS]) for name in report.complete], dtype=dtype)
+
+        return cls(data_dir, records), report
+
+    @classmethod
+    def load(cls, data_dir):
+        """Load the saved index of data_dir, None if there is none or files were added or removed since"""
+        path = Path(data_dir) / cls.filename
+        if not path.exists():
+            return None
+
+        with np.load(path) as saved:
+            if not np.array_equal(saved['mtimes'], _folder_mtimes(data_dir)):
+                return None
+            return cls(data_dir, saved['records'])
+
+    def save(self):
+        """Save the index with the modification times of its folders"""
+        np.savez(self.data_dir / self.filename, records=self.records, mtimes=_folder_mtimes(self.data_dir))
+
+
+def _folder_mtimes(data_dir):
+    """Modification times of FOLDERS, which change whenever a file is added, removed or renamed"""
+    return np.array([os.stat(Path(data_dir) / folder).st_mtime for _, folder, _ in FOLDERS])
+
+
+def check_consistency(data):
+    '''
+    Function to find the names that are not present in every folder
+
+    Each folder is indexed once by name, so the check is linear in the number of files
+
+    Parameters
+    ----------
+    data : dict
+        Maps the name of each folder to the names of its files, without extension
+
+    Returns
+    -------
+    report : ConsistencyReport
+        Names present in every folder, and the folders every other name is missing from
+
+    '''
+
+    # index every folder by file name
+    stems = {folder: set(names) for folder, names in data.items()}
+
+    # names in every folder are complete, all others are missing from at least one folder
+    complete = set.intersection(*stems.values())
+    missing = {}
+    for name in set.union(*stems.values()) - complete:
+        missing[name] = [folder for folder in stems if name not in stems[folder]]
+
+    return ConsistencyReport(sorted(complete), missing)
 
 
 def send_to_debug(data_dir, name):
@@ -113,7 +231,7 @@ def send_to_debug(data_dir, name):
         if not newpath.exists():
             os.makedirs(newpath)
         # move data
-        filepaths = [data_dir / 'videos' / (name + '.mov'), data_dir / 'info' / (name + '.json'), data_dir / 'frame-10s' / (name + '.jpg'), data_dir / 'segmentation' / 'class_color' / (name + '.png'), data_dir / 'segmentation' / 'class_id' / (name + '.png'), data_dir / 'segmentation' / 'instance_color' / (name + '.png'), data_dir / 'segmentation' / 'instance_id' / (name + '.png'), data_dir / 'segmentation' / 'raw_images' / (name + '.jpg')]
+        filepaths = [data_dir / folder / (name + extension) for _, folder, extension in FOLDERS]
         for f in filepaths:
             os.rename(f, newpath / f.name)
         print('Warning: moving video ' + name + ' to', newpath)
@@ -0,0 +1,578 @@
+import os, ctypes, h5py, json
+import numpy as np
+import multiprocessing as mp
+
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+
+
+# arrays written by export_memmap, offsets last
+MEMMAP_ARRAYS = ['frames', 'vectors', 'seg_x', 'seg_y', 'offsets', 'names']
+# packaging manifest of every exported video, written after the arrays
+MEMMAP_STAMP = 'manifests.json'
+
+
+class VideoData:
+    '''
+    Lazy reader of the packaged videoData.h5
+
+    The file stays open and only the samples of each batch are read from it, so memory use does
+    not grow with the number of videos. Every window of window_length frames of a video is one sample:
+        - segmentation input and labels: "frame-10s" and the class ids of "class_id"
+        - LSTM input: the last frame of the window and the ones before it, and "frame-10s" class ids as labels
+        - speed input: the velocity at the same frames, labelled from the frame after the window
+
+    Videos are split 70% train, 20% val and 10% test in the given order, so all windows of a video
+    are in the same split
+
+    Parameters
+    ----------
+    path : string
+        Path to the packaged H5 file
+
+    names : list of strings
+        Names of the videos in sample order, defaults to the order of the H5 file
+
+    window_length : integer
+        Number of frames in each window
+
+    window_stride : integer
+        Frames between the ends of consecutive windows, 0 for a single window per video
+
+    window_end : integer
+        Last frame of the window when window_stride is 0
+
+    '''
+
+    def __init__(self, path, names=None, window_length=2, window_stride=0, window_end=29):
+        self.path = path
+        self.window_length = window_length
+        lengths = self._open(path, names)
+
+        # 70% train, 20% val, 10% test split
+        num_videos = len(self.names)
+        train_split = int(num_videos * 0.7)
+        val_split = int(num_videos * 0.2) + train_split
+        self.train, self.val, self.test = [
+            VideoSplit(self, window_index(lengths, videos, window_length, window_stride, window_end))
+            for videos in np.split(np.arange(num_videos), [train_split, val_split])]
+
+        windows = np.concatenate([split.windows for split in [self.train, self.val, self.test]])
+        # any window, read for the shapes of empty batches
+        self.probe = windows[0] if len(windows) else None
+        skipped = num_videos - len(np.unique(windows[:, 0]))
+        if skipped:
+            print('Warning: {} of {} videos are too short for any window'.format(skipped, num_videos))
+
+    def _open(self, path, names):
+        """Open the data, set the names of the videos and return their number of frames"""
+        self.file = h5py.File(path, 'r')
+
+        # videos without frames are skipped
+        names = list(self.file) if names is None else names
+        self.names = [name for name in names if name in self.file and 'video' in self.file[name]]
+        return np.array([self.file[name]['video'].shape[0] for name in self.names], dtype=np.int64)
+
+    def reopen(self):
+        """Open the file again, for a process that inherited this reader"""
+        self.file = h5py.File(self.path, 'r')
+
+    def frames(self, video):
+        """Frames of a video, read as they are indexed"""
+        return self.file[self.names[video]]['video']
+
+    def manifest(self, video):
+        """Packaging manifest of a video, see package_data"""
+        return self.file[self.names[video]].attrs.get('manifest', '')
+
+    def read(self, windows, lstm_frames=True):
+        '''
+        Function to read the samples of some windows
+
+        Windows are read in file order, so reads of neighbouring windows are coalesced
+
+        Parameters
+        ----------
+        windows : ndarray
+            (video, end) row for each window, where video is an index in self.names
+
+        lstm_frames : boolean
+            Read the frames of the windows, LSTM input is empty if False (e.g. features are cached)
+
+        Returns
+        -------
+        batch : tuple of ndarray
+            Segmentation input and labels, LSTM input and labels, speed input and labels,
+            with no rows if there are no windows
+
+        '''
+
+        if len(windows) == 0:
+            if self.probe is None:
+                raise ValueError('No windows in {}, videos are too short or missing'.format(self.path))
+            # empty arrays with the shapes and types of a sample
+            return tuple(np.empty((0, *x.shape), dtype=x.dtype) for x in self._read_sample(*self.probe, lstm_frames))
+
+        batch = None
+        for i in np.lexsort((windows[:, 1], windows[:, 0])):
+            sample = self._read_sample(windows[i, 0], windows[i, 1], lstm_frames)
+            # allocate the batch from the first sample read
+            if batch is None:
+                batch = tuple(np.empty((len(windows), *x.shape), dtype=x.dtype) for x in sample)
+            for out, x in zip(batch, sample):
+                out[i] = x
+
+        return batch
+
+    def read_seg_x(self, windows):
+        """Read only the segmentation inputs of some windows, in file order"""
+        if len(windows) == 0:
+            return self.read(windows)[0]
+        seg_x = np.empty((len(windows), *self.file[self.names[0]]['frame-10s'].shape), dtype=np.uint8)
+        for i in np.argsort(windows[:, 0], kind='stable'):
+            seg_x[i] = self.file[self.names[windows[i, 0]]]['frame-10s'][()]
+        return seg_x
+
+    def _read_sample(self, video, end, lstm_frames=True):
+        """Read the sample of the window of video ending at frame end"""
+        row = self.file[self.names[video]]
+        video = row['video']
+        vector = row['info']
+        assert video.shape[0] == vector.shape[0]
+
+        frame = row['frame-10s'][()]
+        # Each label is pixel of [class_id, class_id, class_id], convert to single value
+        seg_y = row['class_id'][()][:, :, 0]
+
+        # each window is read as one slab, most recent frame first
+        start = end - self.window_length + 1
+        lstm_x = window(video[start:end + 1], end - start, self.window_length) if lstm_frames else np.zeros(0, np.uint8)
+        lstm_y = frame[:, :, 0]
+
+        # motion data for lstm, labelled by the frame after the window
+        vectors = vector[start:end + 2]
+        speed_x = window(vectors, end - start, self.window_length)
+        speed_y = np.int64(_course_speed_labeler(vectors[-1]))
+
+        return frame, seg_y, lstm_x, lstm_y, speed_x, speed_y
+
+
+class MemmapData(VideoData):
+    '''
+    Reader of the flat arrays written by export_memmap, with the same samples and splits as VideoData
+
+    Arrays are memory-mapped, so reads need no locking, no data is copied until a batch is
+    assembled, and the pages are shared by every process reading the same files
+
+    Parameters
+    ----------
+    path : string
+        Directory written by export_memmap
+
+    See VideoData for the other parameters
+
+    '''
+
+    def _open(self, path, names):
+        """Map the arrays, set the names of the videos and return their number of frames"""
+        arrays = {key: np.load(os.path.join(path, key + '.npy'), mmap_mode='r') for key in MEMMAP_ARRAYS}
+        self.video_frames, self.vectors, self.seg_x, self.seg_y, self.offsets = [arrays[key] for key in MEMMAP_ARRAYS[:-1]]
+
+        # row of every video in the arrays, in sample order
+        rows = {name: row for row, name in enumerate(arrays['names'])}
+        names = list(rows) if names is None else names
+        self.names = [name for name in names if name in rows]
+        self.rows = np.array([rows[name] for name in self.names], dtype=np.int64)
+
+        # manifests of the exported videos, see export_memmap
+        stamp = os.path.join(path, MEMMAP_STAMP)
+        self.manifests = {}
+        if os.path.exists(stamp):
+            with open(stamp) as f:
+                self.manifests = json.load(f)
+        return np.diff(self.offsets)[self.rows]
+
+    def reopen(self):
+        """Maps are shared with child processes, nothing to reopen"""
+        pass
+
+    def frames(self, video):
+        """Frames of a video, a view of the mapped frames"""
+        row = self.rows[video]
+        return self.video_frames[self.offsets[row]:self.offsets[row + 1]]
+
+    def manifest(self, video):
+        """Packaging manifest the video was exported with"""
+        return self.manifests.get(self.names[video], '')
+
+    def read_seg_x(self, windows):
+        """Read only the segmentation inputs of some windows"""
+        return self.seg_x[self.rows[windows[:, 0]]]
+
+    def _read_sample(self, video, end, lstm_frames=True):
+        """Read the sample of the window of video ending at frame end"""
+        row = self.rows[video]
+        start, stop = self.offsets[row], self.offsets[row + 1]
+
+        frame = self.seg_x[row]
+        # the window and its label are views of the mapped arrays
+        lstm_x = window(self.frames(video), end, self.window_length) if lstm_frames else np.zeros(0, np.uint8)
+        vectors = self.vectors[start:stop]
+        speed_x = window(vectors, end, self.window_length)
+        speed_y = np.int64(_course_speed_labeler(vectors[end + 1]))
+
+        return frame, self.seg_y[row], lstm_x, frame[:, :, 0], speed_x, speed_y
+
+
+class VideoSplit:
+    '''
+    View of the train, val or test windows of VideoData
+
+    Indices passed to a split are relative to the split
+
+    '''
+
+    def __init__(self, data, windows):
+        self.data = data
+        self.windows = windows
+
+    def __len__(self):
+        return len(self.windows)
+
+    def batch(self, ind):
+        """Read the samples ind of the split, see VideoData.read"""
+        return self.data.read(self.windows[ind])
+
+    def seg_x(self, ind):
+        """Read only the segmentation inputs ind of the split"""
+        return self.data.read_seg_x(self.windows[ind])
+
+    def reopen(self):
+        """Reopen the data, see VideoData.reopen"""
+        self.data.reopen()
+
+    @property
+    def shapes(self):
+        """Shapes of the whole split for each array of a batch"""
+        return tuple((len(self), *x.shape[1:]) for x in self.batch([]))
+
+
+class ArraySplit:
+    '''
+    In memory split with the same interface as VideoSplit
+
+    Parameters
+    ----------
+    arrays : tuple of ndarray
+        Segmentation input and labels, LSTM input and labels, speed input and labels
+
+    '''
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.arrays[0])
+
+    def batch(self, ind):
+        return tuple(x[ind] for x in self.arrays)
+
+    def seg_x(self, ind):
+        return self.arrays[0][ind]
+
+    def reopen(self):
+        pass
+
+    @property
+    def shapes(self):
+        return tuple(x.shape for x in self.arrays)
+
+
+class BatchLoader:
+    '''
+    Iterator over random training batches of a split, assembled by worker processes
+
+    Workers write batches into a ring of shared memory slots, and the training loop reads them in
+    place, so batches are never pickled or copied between processes. Slot s holds batches
+    s, s + slots, ... and is only written by worker s % workers. Each slot has two semaphores,
+    "empty" released when the training loop is done with it and "full" released when a worker
+    wrote a batch to it
+
+    Batch k holds batch_size samples drawn with replacement by RandomState([seed, k]), so batches
+    are the same for any number of workers
+
+    Parameters
+    ----------
+    split : VideoSplit, ArraySplit
+        Split the batches are drawn from
+
+    batch_size : integer
+        Number of samples in each batch
+
+    workers : integer
+        Number of worker processes, batches are read in this process if 0
+
+    seed : integer
+        Seed of the batches
+
+    start : integer
+        Index of the first batch, to resume training
+
+    copy : boolean
+        Return copies of the slots, for consumers that keep batches past the next call (e.g. a
+        prefetching tf.data pipeline). Slots are then written again as soon as they are copied
+
+    '''
+
+    def __init__(self, split, batch_size, workers=0, seed=0, start=0, copy=False):
+        self.split = split
+        self.batch_size = batch_size
+        self.workers = workers
+        self.seed = seed
+        self.k = start
+        self.copy = copy
+        self.processes = []
+        # slot of the batch returned last
+        self.held = None
+        if workers == 0:
+            return
+
+        # each worker owns two slots, so it can read a batch while the previous one is used
+        self.slots = 2 * workers
+        # arrays of a batch of one sample, some arrays have several rows per sample (e.g. features)
+        sample = split.batch([0])
+        self.buffers = [[mp.RawArray(ctypes.c_uint8, batch_size * x.nbytes) for x in sample] for _ in range(self.slots)]
+        self.arrays = [[np.frombuffer(buffer, dtype=x.dtype).reshape(batch_size * len(x), *x.shape[1:]) for buffer, x in zip(buffers, sample)]
+                       for buffers in self.buffers]
+        self.empty = [mp.Semaphore(1) for _ in range(self.slots)]
+        self.full = [mp.Semaphore(0) for _ in range(self.slots)]
+
+        for worker in range(workers):
+            process = mp.Process(target=self._work, args=(worker,), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def indices(self, k):
+        """Sample indices of batch k"""
+        return np.random.RandomState([self.seed, k]).choice(len(self.split), self.batch_size, replace=True)
+
+    def _work(self, worker):
+        """Write batches worker, worker + workers, ... to their slots until the process is stopped"""
+        self.split.reopen()
+        k = self.k + (worker - self.k) % self.workers
+        while True:
+            slot = k % self.slots
+            self.empty[slot].acquire()
+            for out, x in zip(self.arrays[slot], self.split.batch(self.indices(k))):
+                out[...] = x
+            self.full[slot].release()
+            k += self.workers
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        '''
+        Function to get the next batch
+
+        With workers and without copy, the arrays are views of a shared slot and are only valid
+        until the next call
+        '''
+
+        k = self.k
+        self.k += 1
+        if not self.processes:
+            return self.split.batch(self.indices(k))
+
+        # the previous batch is no longer used, its slot can be written again
+        if self.held is not None:
+            self.empty[self.held].release()
+            self.held = None
+
+        slot = k % self.slots
+        while not self.full[slot].acquire(timeout=1):
+            if not all(process.is_alive() for process in self.processes):
+                raise RuntimeError('Batch loader worker stopped')
+
+        if self.copy:
+            batch = tuple(x.copy() for x in self.arrays[slot])
+            self.empty[slot].release()
+            return batch
+
+        self.held = slot
+        return tuple(self.arrays[slot])
+
+    def close(self):
+        """Stop the workers"""
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = []
+
+
+def export_memmap(h5_path, out_dir):
+    '''
+    Function to export the packaged videos to flat arrays that MemmapData can map
+
+    Writes one .npy file for each of MEMMAP_ARRAYS to "out_dir":
+        - frames, vectors: the frames and velocities of all videos, concatenated
+        - seg_x, seg_y: "frame-10s" and the class ids of "class_id" of every video
+        - offsets: the frames of video i are rows offsets[i]:offsets[i + 1] of frames and vectors
+        - names: the name of every video
+
+    and MEMMAP_STAMP, the packaging manifest of every video, see memmap_current
+
+    Videos are copied one at a time, so memory use does not grow with the number of videos
+
+    Parameters
+    ----------
+    h5_path : string
+        Path to the packaged H5 file
+
+    out_dir : string
+        Directory the arrays are written to, created if needed
+
+    '''
+
+    os.makedirs(out_dir, exist_ok=True)
+    # the stamp is removed first and written last, so an interrupted export is exported again
+    stamp = os.path.join(out_dir, MEMMAP_STAMP)
+    if os.path.exists(stamp):
+        os.remove(stamp)
+
+    with h5py.File(h5_path, 'r') as f:
+        names = [name for name in f if 'video' in f[name]]
+        if not names:
+            print('Error: no videos in', h5_path)
+            return
+        manifests = _manifests(f)
+        offsets = np.concatenate([[0], np.cumsum([f[name]['video'].shape[0] for name in names])]).astype(np.int64)
+
+        # allocate the arrays on disk with the shapes of the first video
+        first = f[names[0]]
+        total = int(offsets[-1])
+        shapes = {
+            'frames': ((total, *first['video'].shape[1:]), np.uint8),
+            'vectors': ((total, *first['info'].shape[1:]), np.float32),
+            'seg_x': ((len(names), *first['frame-10s'].shape), np.uint8),
+            'seg_y': ((len(names), *first['class_id'].shape[:2]), np.uint8),
+        }
+        arrays = {key: open_memmap(os.path.join(out_dir, key + '.npy'), mode='w+', dtype=dtype, shape=shape)
+                  for key, (shape, dtype) in shapes.items()}
+
+        for i, name in enumerate(tqdm(names)):
+            row = f[name]
+            assert row['video'].shape[0] == row['info'].shape[0]
+            row['video'].read_direct(arrays['frames'], dest_sel=np.s_[offsets[i]:offsets[i + 1]])
+            arrays['vectors'][offsets[i]:offsets[i + 1]] = row['info'][()]
+            arrays['seg_x'][i] = row['frame-10s'][()]
+            arrays['seg_y'][i] = row['class_id'][()][:, :, 0]
+
+    for array in arrays.values():
+        array.flush()
+    np.save(os.path.join(out_dir, 'names.npy'), np.array(names))
+    # offsets are written last, so an interrupted export is never read
+    np.save(os.path.join(out_dir, 'offsets.npy'), offsets)
+    with open(stamp, 'w') as f:
+        json.dump(manifests, f)
+
+
+def memmap_current(h5_path, out_dir):
+    '''
+    Function to check if the arrays in "out_dir" were exported from the videos now in "h5_path"
+
+    Compares the packaging manifests of the videos rather than modification times, as packaging
+    opens the H5 file for writing whenever any video changed
+    '''
+
+    stamp = os.path.join(out_dir, MEMMAP_STAMP)
+    if not os.path.exists(stamp) or not os.path.exists(h5_path):
+        return False
+    with open(stamp) as f:
+        exported = json.load(f)
+    with h5py.File(h5_path, 'r') as f:
+        return exported == _manifests(f)
+
+
+def _manifests(f):
+    """Packaging manifest of every video group of an open H5 file, by name"""
+    return {name: f[name].attrs.get('manifest', '') for name in f if 'video' in f[name]}
+
+
+def window_index(lengths, videos, length, stride, end=29):
+    '''
+    Function to index all windows of some videos up front
+
+    Windows end at frames length - 1, length - 1 + stride, ... of each video, leaving at least
+    one frame after the window for its label. If stride is 0 every video has a single window
+    ending at frame "end", and videos too short for it have none
+
+    Parameters
+    ----------
+    lengths : ndarray
+        Number of frames of every video
+
+    videos : ndarray
+        Indices of the videos to index
+
+    length, stride, end : integer
+        See VideoData
+
+    Returns
+    -------
+    windows : ndarray
+        (video, end) row for each window, sorted by video and end
+
+    '''
+
+    windows = [np.zeros((0, 2), dtype=np.int64)]
+    for video in videos:
+        if stride > 0:
+            ends = np.arange(length - 1, lengths[video] - 1, stride)
+        else:
+            ends = np.array([end] if length - 1 <= end < lengths[video] - 1 else [], dtype=np.int64)
+        windows.append(np.stack([np.full(len(ends), video), ends], axis=1).astype(np.int64))
+
+    return np.concatenate(windows)
+
+
+def window(frames, end, length):
+    '''
+    Function to get the window of length frames ending at frame end, most recent frame first
+
+    The window is a view of frames, no data is copied for arrays and memmaps
+    '''
+
+    return frames[end - length + 1:end + 1][::-1]
+
+
+def input_stats(split, chunk_size=256):
+    '''
+    Function to get the mean, std, min and max of the segmentation inputs of a split
+
+    Inputs are read chunk_size samples at a time, so memory use is bounded
+
+    '''
+
+    total, total_sq, count = 0.0, 0.0, 0
+    low, high = np.inf, -np.inf
+    for start in range(0, len(split), chunk_size):
+        x = split.seg_x(np.arange(start, min(start + chunk_size, len(split)))).astype(np.float64)
+        total += x.sum()
+        total_sq += np.square(x).sum()
+        count += x.size
+        low, high = min(low, x.min()), max(high, x.max())
+
+    mean = total / count
+    return mean, np.sqrt(max(total_sq / count - mean ** 2, 0)), low, high
+
+
+def _course_speed_labeler(speed):
+    if speed[0] < 1:
+        return 1
+    if abs(speed[1]) < 6:
+        return 2
+    if speed[1] < 0:
+        return 3
+    else:
+        return 4
@@ -0,0 +1,166 @@
+import os, h5py
+import numpy as np
+
+from collections import OrderedDict
+from tqdm import tqdm
+
+from .preprocessing import _dataset_options
+
+
+class FeatureCache:
+    '''
+    AlexNet features of packaged frames, stored in an H5 file with a bounded in-memory LRU
+
+    The file holds one dataset per video, named after it, whose row i holds the float16 features
+    of frame i
+    Features of overlapping windows are read once and then served from memory, while the LRU holds
+    at most "capacity" frames
+
+    Parameters
+    ----------
+    path : string
+        Path to the H5 cache, see precompute_features
+
+    capacity : integer
+        Number of frames kept in memory
+
+    '''
+
+    def __init__(self, path, capacity=256):
+        self.path = path
+        self.capacity = capacity
+        self.file = h5py.File(path, 'r')
+        self.lru = OrderedDict()
+
+    def reopen(self):
+        """Open the file again and start with an empty LRU, for a process that inherited this cache"""
+        self.file = h5py.File(self.path, 'r')
+        self.lru = OrderedDict()
+
+    def get(self, name, frame):
+        """Features of one frame of video name"""
+        key = (name, frame)
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            return self.lru[key]
+
+        features = self.file[name][frame]
+        self.lru[key] = features
+        if len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+        return features
+
+    def window(self, name, end, length):
+        """Features of the window of length frames ending at frame end, most recent frame first"""
+        return np.stack([self.get(name, frame) for frame in range(end, end - length, -1)])
+
+
+class FeatureSplit:
+    '''
+    Split whose LSTM input is the cached features of each window instead of its frames
+
+    Batches hold the features of every frame of every window as one (N * T, ...) array, in the
+    layout of the "lstm_features" tensor of Network, so they can be fed in its place
+
+    Parameters
+    ----------
+    split : VideoSplit
+        Split of VideoData or MemmapData
+
+    cache : FeatureCache
+        Features of the videos of the split
+
+    '''
+
+    def __init__(self, split, cache):
+        self.split = split
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.split)
+
+    def batch(self, ind):
+        """Read the samples ind of the split, with window features as LSTM input"""
+        windows = self.split.windows[ind]
+        batch = list(self.split.data.read(windows, lstm_frames=False))
+        names = self.split.data.names
+        length = self.split.data.window_length
+        # an empty batch has no features, with the shape of those of any window
+        probe = windows if len(windows) else [self.split.data.probe]
+        features = np.concatenate([self.cache.window(names[video], end, length) for video, end in probe])
+        batch[2] = features if len(windows) else features[:0]
+        return tuple(batch)
+
+    def seg_x(self, ind):
+        return self.split.seg_x(ind)
+
+    def reopen(self):
+        self.split.reopen()
+        self.cache.reopen()
+
+
+def precompute_features(path, data, features_fn, source, batch_size=32):
+    '''
+    Function to run the AlexNet tower once on every frame of every video, and cache the features
+
+    Videos cached from the same packaged frames are skipped, others are computed again, and the
+    cache is built again if it was computed by a different tower. Features are stored as gzip
+    compressed float16 with one chunk per frame, for AlexNet (9, 9, 4096) features that is at
+    most 0.66 MB per frame, ~3.7 times the packaged frame
+
+    Parameters
+    ----------
+    path : string
+        Path to the H5 cache, see FeatureCache
+
+    data : VideoData or MemmapData
+        Packaged videos
+
+    features_fn : function
+        Maps a (N, 244, 244, 3) batch of frames to their features, e.g. PretrainedTower.features
+
+    source : string
+        Identifies the tower, e.g. its weights and normalization
+
+    batch_size : integer
+        Number of frames run through the tower at once
+
+    '''
+
+    if os.path.exists(path):
+        with h5py.File(path, 'r') as f:
+            current = f.attrs.get('source') == source
+        if not current:
+            print('Feature cache {} was computed by another tower, computing it again'.format(path))
+            os.remove(path)
+
+    with h5py.File(path, 'a') as f:
+        f.attrs['source'] = source
+        todo = [video for video, name in enumerate(data.names)
+                if not _is_cached(f, name, data.manifest(video), len(data.frames(video)))]
+        print('Computing features of {} of {} videos, {} cached'.format(len(todo), len(data.names), len(data.names) - len(todo)))
+
+        for video in tqdm(todo):
+            frames = data.frames(video)
+            features = None
+            for start in range(0, len(frames), batch_size):
+                batch = features_fn(frames[start:start + batch_size])
+                # allocate the video from the first batch, one chunk per frame for random reads
+                if features is None:
+                    features = np.empty((len(frames), *batch.shape[1:]), dtype=np.float16)
+                features[start:start + len(batch)] = batch
+
+            # videos are written in one call once all their features are computed
+            name = data.names[video]
+            if name in f:
+                del f[name]
+            dataset = f.create_dataset(name, data=features,
+                                       **_dataset_options('video', features.shape, compression='gzip'))
+            # written last, so an interrupted write is computed again on the next run
+            dataset.attrs['manifest'] = data.manifest(video)
+            dataset.attrs['frames'] = len(frames)
+
+
+def _is_cached(f, name, manifest, frames):
+    """Check if the features of a video were computed from the frames packaged with manifest"""
+    return name in f and f[name].attrs.get('manifest') == manifest and f[name].attrs.get('frames') == frames
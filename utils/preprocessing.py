@@ -1,16 +1,24 @@
-import glob, h5py, cv2, json
+import h5py, cv2, json
 import numpy as np
 
+from multiprocessing import Pool
 from skimage.transform import resize
 from tqdm import tqdm
 
-from pathlib import Path, PurePath
+# optional, registers the lz4 filter with HDF5
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
 
-from .checkData import check_data
-from .processInfo import read_json
+from pathlib import Path
 
+from .checkData import check_data, send_to_debug
+from .processInfo import load_info, frame_velocity, INFO_REASONS
+from .scanVideos import scan_videos
 
-def package_data(data_dir):
+
+def package_data(data_dir, workers=1, resize_backend='skimage', force=False, chunked=False, compression='none', shuffle=False, seed=None):
     '''
     Author: Jordan Patterson
     
@@ -27,113 +35,305 @@ def package_data(data_dir):
             -"instance_id"
             -"raw_images"
 
-    The names of the files in "videos", "info", "frame-10s" and "segmentation" must match each other at each index
+    The names of the files in "videos", "info", "frame-10s" and "segmentation" must match each other
     Any inconsistent files will be placed in a "debug" folder, which is ignored by the program
 
+    Packaging is incremental: every group stores a manifest of its source files (path, size, mtime)
+    and packaging parameters, and videos whose manifest is unchanged are not packaged again
+
     Parameters
     ----------
     data_dir : string
         Absolute path to the directory containing folders "videos", "info", "frame-10s" and "segmentation"
 
+    workers : integer
+        Number of worker processes probing, decoding and resizing videos. The calling process is the only
+        writer of videoData.h5, and groups are written in the same order as the serial path (workers=1)
+
+    resize_backend : string
+        Library used to downsample frames and images, "skimage" or "opencv" (see _resize)
+
+    force : boolean
+        Package every video, even if its group is up to date
+
+    chunked : boolean
+        Store one frame per chunk for "video" and one chunk per image for the other datasets, so
+        reading a single frame does not touch the rest of the video (see _dataset_options)
+
+    compression : string
+        Compression filter for every dataset, "none", "gzip" or "lz4" (requires hdf5plugin)
+
+    shuffle : boolean
+        Apply the byte shuffle filter before compression
+
+    seed : integer
+        Seed for the order videos are packaged in, see check_data
+
     '''
 
     # use pathlib
     data_dir = Path(data_dir)
 
-    # checks all data in path specified at data_dir and returns the prepared data if valid
-    videos, info, frames, class_colour, class_id, instance_colour, instance_id, raw_images = check_data(data_dir)
+    # checks all data in path specified at data_dir and returns the index of valid samples
+    index = check_data(data_dir, seed)
+    if index is None:
+        return
 
-    # open file for r/w ('a' specifies not to overwrite)
-    h5f = h5py.File('videoData.h5', 'a')
+    # decode videos in worker processes, results are returned in job order
+    pool = Pool(workers) if workers > 1 else None
+
+    # parse and validate every info file once, reusing the cached records from previous runs
+    infos = load_info(index.column('info'), cache_path=data_dir / 'infoCache.h5', pool=pool)
+
+    # move videos with invalid info to debug before decoding anything
+    valid = np.array([infos[name]['valid'] for name in index.names], dtype=bool)
+    for name in np.asarray(index.names)[~valid]:
+        print('Warning: invalid info for video {}: {}'.format(name, INFO_REASONS[infos[name]['reason']]))
+        send_to_debug(data_dir, name)
+    index = index.subset(valid)
+
+    # probe every video once, reusing the cached index from previous runs
+    metadata = scan_videos(index.column('videos'), index_path=data_dir / 'videoIndex.json', pool=pool)
 
     # keep track of shortest video, and cut all videos to this length
-    framecount = lambda video: int(cv2.VideoCapture(str(video)).get(cv2.CAP_PROP_FRAME_COUNT))
-    min_frames = framecount(min(videos, key=framecount))
-
-    # loops through all videos
-    for i in tqdm(range(len(videos))):
-        # gets name of video
-        name = videos[i].stem
-        # open video for frame processing
-        video = cv2.VideoCapture(str(videos[i]))
-
-        # ensure video opens successfully
-        if not video.isOpened():
-            video.release()
-            # if it fails, move video to debug directory
-            send_to_debug(data_dir, name)
-            continue
+    min_frames = min((meta['frames'] for meta in metadata.values() if meta['opened']), default=0)
 
-        # get framerate
-        fps = int(np.rint(video.get(cv2.CAP_PROP_FPS)))
-
-        videodata = []
-        count = 0
-        # set refresh rate to 3hz
-        hz = fps / 3
-
-        # process video frame by frame
-        while video.isOpened():
-            # get frame of video
-            ret, frame = cv2.VideoCapture.read(video)
-                
-            # check if we have reached end of video
-            if ret != True or count == min_frames:
-                break
+    # one job per video, holding every path needed to package it
+    params = {'min_frames': min_frames, 'resize_backend': resize_backend,
+              'chunked': chunked, 'compression': compression, 'shuffle': shuffle}
+    jobs = [(index.paths(i), min_frames, resize_backend, infos[name]) for i, name in enumerate(index.names)]
+    manifests = [_manifest(job[0], params) for job in jobs]
 
-            # record frame at 3hz with downsampled resolution
-            if int(count % hz) == 0:
-                frame = _resize(frame)
-                videodata.append(frame)
+    # skip videos already packaged from the same files with the same parameters
+    stale = list(range(len(jobs)))
+    if not force and Path('videoData.h5').exists():
+        with h5py.File('videoData.h5', 'r') as h5f:
+            stale = [i for i in stale if not _is_current(h5f, jobs[i][0][0].stem, manifests[i])]
+    print('Packaging {} of {} videos, {} up to date'.format(len(stale), len(jobs), len(jobs) - len(stale)))
+    jobs = [jobs[i] for i in stale]
+    manifests = [manifests[i] for i in stale]
 
-            # count frames to ensure 3hz
-            count += 1
+    # an up to date file is left untouched, so readers can tell it did not change
+    if not jobs:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        return
 
-        # close video object
-        video.release()
-        # get data ready to write
-        video_data = np.asarray(videodata)
-        info_data = read_json(info[i], min_frames, hz)
-        if info_data is None:
+    # open file for r/w ('a' specifies not to overwrite), only after worker processes are forked
+    h5f = h5py.File('videoData.h5', 'a')
+
+    results = pool.imap(_package_video, jobs) if pool is not None else map(_package_video, jobs)
+
+    # write each finished video as it arrives
+    for (name, datasets), manifest in tqdm(zip(results, manifests), total=len(jobs)):
+        # video was invalid and moved to debug
+        if datasets is None:
             continue
-        frame_data = cv2.imread(str(frames[i]), 1)
-        class_colour_data = cv2.imread(str(class_colour[i]), 1)
-        class_id_data = cv2.imread(str(class_id[i]), 1)
-        instance_colour_data = cv2.imread(str(instance_colour[i]), 1)
-        instance_id_data = cv2.imread(str(instance_id[i]), 1)
-        raw_images_data = cv2.imread(str(raw_images[i]), 1)
-        # resize images
-        frame_data = _resize(frame_data)
-        class_colour_data = _resize(class_colour_data)
-        class_id_data = _resize(class_id_data)
-        instance_colour_data = _resize(instance_colour_data)
-        instance_id_data = _resize(instance_id_data)
-        raw_images_data = _resize(raw_images_data)
 
         # write group for videoname
         try:
             group = h5f.create_group(name)
-        # if group already exists, delete and recreate it
+        # if group already exists it is out of date, delete and recreate it
         except ValueError:
-            print('Warning: group ' + name + ' already defined, resetting this group')
+            print('Warning: group ' + name + ' out of date, resetting this group')
             del h5f[name]
             group = h5f.create_group(name)
 
         # write datasets to video group
-        group.create_dataset('video', data=video_data, dtype='uint8')
-        group.create_dataset('info', data=info_data)
-        group.create_dataset('frame-10s', data=frame_data, dtype='uint8')
-        group.create_dataset('class_colour', data=class_colour_data, dtype='uint8')
-        group.create_dataset('class_id', data=class_id_data, dtype='uint8')
-        group.create_dataset('instance_colour', data=instance_colour_data, dtype='uint8')
-        group.create_dataset('instance_id', data=instance_id_data, dtype='uint8')
-        group.create_dataset('raw_images', data=raw_images_data, dtype='uint8')
+        for key, data in datasets:
+            group.create_dataset(key, data=data, dtype=data.dtype,
+                                 **_dataset_options(key, data.shape, chunked, compression, shuffle))
+
+        # write manifest last, so an interrupted write is packaged again on the next run
+        group.attrs['manifest'] = manifest
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     # close file
     h5f.close()
 
 
-def _resize(image, dims=(244, 244, 3)):
-    """Resize image to dims, preserve range (keep data from [0-255])"""
-    return resize(image, dims, preserve_range=True)
-    
\ No newline at end of file
+def _dataset_options(key, shape, chunked=False, compression='none', shuffle=False):
+    '''
+    Function to get the storage layout keyword arguments for create_dataset
+
+    The training loader reads single frames out of "video", so it is chunked one frame per chunk,
+    while images, labels and info are always read whole and stored as a single chunk. HDF5 filters
+    require chunked storage, so compression or shuffle imply chunking
+
+    Parameters
+    ----------
+    key : string
+        Name of the dataset in its video group
+
+    shape : tuple
+        Shape of the dataset
+
+    chunked, compression, shuffle
+        See package_data
+
+    '''
+
+    options = {}
+    if not (chunked or compression != 'none' or shuffle) or 0 in shape:
+        return options
+
+    options['chunks'] = (1, *shape[1:]) if key == 'video' else shape
+    if shuffle:
+        options['shuffle'] = True
+    if compression == 'gzip':
+        options['compression'] = 'gzip'
+    elif compression == 'lz4':
+        if hdf5plugin is None:
+            raise ImportError('hdf5plugin is required for lz4 compression')
+        options.update(hdf5plugin.LZ4())
+
+    return options
+
+
+def _manifest(paths, params):
+    """Json manifest of the source files and packaging parameters of one video group"""
+    sources = []
+    for path in paths:
+        stat = Path(path).stat()
+        sources.append([str(path), stat.st_size, stat.st_mtime])
+    return json.dumps({'sources': sources, 'params': params}, sort_keys=True)
+
+
+def _is_current(h5f, name, manifest):
+    """Check if the group for a video was completely written from the files in manifest"""
+    return name in h5f and h5f[name].attrs.get('manifest') == manifest
+
+
+def _package_video(job):
+    '''
+    Author: Jordan Patterson
+
+    Function to decode, sample and resize one video along with its info, images and labels
+
+    Safe to run in a worker process: nothing is written to videoData.h5 here
+
+    Parameters
+    ----------
+    job : tuple
+        Paths of the video, info, frame-10s and segmentation files, the number of frames to keep, the
+        resize backend and the validated info record (see processInfo.load_info)
+
+    Returns
+    -------
+    name : string
+        Name of the video
+
+    datasets : list of (string, ndarray) tuples or None
+        Datasets to write to the video group in order, None if the video was sent to debug
+
+    '''
+
+    paths, min_frames, resize_backend, info_record = job
+    videopath, info, frames, class_colour, class_id, instance_colour, instance_id, raw_images = paths
+
+    # gets name of video
+    name = videopath.stem
+    # open video for frame processing
+    video = cv2.VideoCapture(str(videopath))
+
+    # ensure video opens successfully
+    if not video.isOpened():
+        video.release()
+        # if it fails, move video to debug directory
+        send_to_debug(videopath.parents[1], name)
+        return name, None
+
+    # get framerate
+    fps = int(np.rint(video.get(cv2.CAP_PROP_FPS)))
+
+    # set refresh rate to 3hz
+    hz = fps / 3
+
+    # preallocate the whole clip, so memory per video is bounded by the number of kept frames
+    video_data = np.empty((_num_kept(min_frames, hz), 244, 244, 3), dtype=np.uint8)
+
+    # record frames at 3hz with downsampled resolution, straight into the clip
+    kept = 0
+    for frame in _sample_frames(video, min_frames, hz):
+        _resize(frame, backend=resize_backend, out=video_data[kept])
+        kept += 1
+
+    # close video object
+    video.release()
+    # drop unused frames if the video ended early
+    video_data = video_data[:kept]
+    # get data ready to write
+    info_data = frame_velocity(info_record['timestamp'], info_record['speed'], info_record['course'],
+                               info_record['startTime'], min_frames, hz)
+
+    datasets = [('video', video_data), ('info', info_data)]
+    # read and resize images
+    for key, path in [('frame-10s', frames), ('class_colour', class_colour), ('class_id', class_id), ('instance_colour', instance_colour), ('instance_id', instance_id), ('raw_images', raw_images)]:
+        datasets.append((key, _resize(cv2.imread(str(path), 1), backend=resize_backend)))
+
+    return name, datasets
+
+
+def _sample_frames(video, num_frames, hz):
+    '''
+    Author: Jordan Patterson
+
+    Generator over the frames of an opened video that are kept at the 3hz refresh rate
+
+    Every frame is grabbed to advance the stream, but only kept frames are retrieved, so skipped
+    frames never pay for colour conversion or a copy into a numpy array. Kept frames are retrieved
+    into the same buffer, so each frame must be used before the next one is requested
+
+    Parameters
+    ----------
+    video : cv2.VideoCapture object
+        Opened video to sample
+
+    num_frames : integer
+        Number of frames of the video to consider, all videos are cut to this length
+
+    hz : float
+        Number of frames between kept frames
+
+    '''
+
+    count = 0
+    frame = None
+    # stop at the end of the video or when the video has been cut to length
+    while count < num_frames and video.grab():
+        # keep frame at 3hz
+        if int(count % hz) == 0:
+            ret, frame = video.retrieve(frame)
+            if not ret:
+                break
+            yield frame
+
+        # count frames to ensure 3hz
+        count += 1
+
+
+def _num_kept(num_frames, hz):
+    """Number of frames _sample_frames keeps from a video cut to num_frames"""
+    return sum(1 for count in range(num_frames) if int(count % hz) == 0)
+
+
+def _resize(image, dims=(244, 244, 3), backend='skimage', out=None):
+    """
+    Resize image to dims as uint8, preserve range (keep data from [0-255])
+
+    The "skimage" backend interpolates in float64 and truncates to uint8, which is what packaged
+    data has always contained. The "opencv" backend uses area interpolation and stays in uint8 end
+    to end, it is many times faster and within a gray level of skimage on average (see benchmark.py)
+
+    If out is given, the result is written into it in place and out is returned
+    """
+    if backend == 'opencv':
+        return cv2.resize(image, (dims[1], dims[0]), dst=out, interpolation=cv2.INTER_AREA)
+    if out is None:
+        return resize(image, dims, preserve_range=True).astype(np.uint8)
+    out[...] = resize(image, dims, preserve_range=True)
+    return out
@@ -1,12 +1,27 @@
 
-import json, math
+import os, json, h5py
 import numpy as np
 
-from pathlib import Path, PurePath
+from pathlib import Path
 
 from .checkData import send_to_debug
 
 
+# columns of the location data kept after validation
+INFO_COLUMNS = ['timestamp', 'speed', 'course']
+
+# reasons returned by check_info
+INFO_REASONS = {
+    'ok': 'valid',
+    'empty': 'no locations',
+    'start_end': 'locations start or end more than 2s away from the video',
+    'timestamp_gap': 'more than 1.1s between two locations',
+    'timestamp_order': 'locations are not in time order',
+    'missing_keys': 'a location has fewer than 6 keys',
+    'missing_values': 'too many missing (-1) values',
+}
+
+
 def read_json(filename, num_frames, hz):
     '''
     Author: Jordan Patterson
@@ -26,112 +41,272 @@ def read_json(filename, num_frames, hz):
 
     '''
 
-    # parse locations from json file
-    info = json.load(open(filename))
-    locations = info['locations']
-    
+    record = parse_info(filename)
+
     # ensure json is valid
-    if not check_info(info, locations):
+    if not record['valid']:
         send_to_debug(Path(filename).parents[1], filename.stem)
         return
 
-    data = {}
+    return frame_velocity(record['timestamp'], record['speed'], record['course'], record['startTime'], num_frames, hz)
+
+
+def parse_info(filename):
+    '''
+    Function to parse and validate one JSON info file
+
+    Parameters
+    ----------
+    filename : PurePath object
+        Absolute path to the json file being parsed
+
+    Returns
+    -------
+    record : dict
+        "mtime" of the file, "valid", "reason" (see check_info), "startTime", "endTime", and a 1d
+        array for each of INFO_COLUMNS with missing values filled, empty if the file is not valid
+
+    '''
+
+    # parse locations from json file
+    with open(filename) as f:
+        info = json.load(f)
+    locations = info['locations']
+
+    record = {'mtime': os.stat(filename).st_mtime, 'startTime': info['startTime'], 'endTime': info['endTime']}
+
     # change data in locations to keys containing a 1d array of all associated values
-    for key in locations[0].keys():
-        data[key] = np.array([idx[key] for idx in locations]).ravel()
+    keys = dict.fromkeys(key for loc in locations for key in loc)
+    columns = {key: np.array([loc.get(key, np.nan) for loc in locations], dtype=np.float64) for key in keys}
+    num_keys = np.array([len(loc) for loc in locations], dtype=np.int64)
 
-    data['startTime'] = info['startTime']
-    data['endTime'] = info['endTime']
+    # ensure json is valid, this also fills missing values
+    record['reason'] = check_info(info['startTime'], info['endTime'], columns, num_keys)
+    record['valid'] = record['reason'] == 'ok'
 
-    velocity = np.zeros((len(data['course']), 2), dtype=np.float32)
-    # create direction vector for every speed and course scalar
-    for i in range(len(data['course'])):
-        t = math.radians(data['course'][i])
-        velocity[i, :] = np.array([math.sin(t) * data['speed'][i], math.cos(t) * data['speed'][i]])
+    for key in INFO_COLUMNS:
+        record[key] = columns[key] if record['valid'] else np.zeros(0)
 
-    frame_velocity = np.zeros((num_frames, 2), dtype=np.float32)
-    t_prev = 0
-    
-    # get velocity at current frame
-    for frame in range(num_frames):
-        # get current time in timestamp (location data is collected every second)
-        t_cur = frame * 1000 / hz + data['startTime']
-
-        # make sure current time is after first time
-        if t_cur < data['timestamp'][0]:
-            frame_velocity[frame, :] = velocity[0, :]
-            continue
-
-        # find timestamp before t_cur
-        try:
-            while data['timestamp'][t_prev + 1] < t_cur:
-                t_prev += 1
-        # last timestamp for locations reached
-        except IndexError:
-            frame_velocity[frame, :] = velocity[t_prev, :]
-            continue
-
-        # t_cur is between t_prev and t_next
+    return record
+
+
+def load_info(filenames, cache_path=None, pool=None):
+    '''
+    Function to parse and validate all JSON info files, reusing a columnar cache
+
+    The cache is an H5 file holding one row per file ("name", "mtime", "valid", "reason", "startTime",
+    "endTime", "offset") and the locations of all files concatenated in one column each for
+    INFO_COLUMNS, where the locations of file i are rows offset[i]:offset[i + 1]. Files are only
+    parsed again if their modification time changed
+
+    Parameters
+    ----------
+    filenames : list of PurePath objects
+        Absolute paths to the json files
+
+    cache_path : PurePath object
+        Path of the H5 cache to read and update, nothing is cached if None
+
+    pool : multiprocessing.Pool object
+        Pool used to parse files in parallel, files are parsed in this process if None
+
+    Returns
+    -------
+    records : dict
+        Maps the name of each file without extension to its record, see parse_info
+
+    '''
+
+    cached = _read_info_cache(cache_path) if cache_path is not None and Path(cache_path).exists() else {}
+
+    records = {}
+    stale = []
+    for filename in filenames:
+        record = cached.get(filename.stem)
+        # reuse record only if the file has not been modified since it was parsed
+        if record is not None and record['mtime'] == os.stat(filename).st_mtime:
+            records[filename.stem] = record
         else:
-            t_next = t_prev + 1
-            # get difference between current time and previous/next time
-            t1 = t_cur - data['timestamp'][t_prev]
-            t2 = data['timestamp'][t_next] - t_cur
-            # normalize differences in time
-            r1 = t2 / (t1 + t2)
-            r2 = t1 / (t1 + t2)
-            # get current velocity between two timestamps
-            frame_velocity[frame, :] = r1 * velocity[t_prev, :] + r2 * velocity[t_next, :]
-
-    # align with framerate (3hz)
-    frame_velocity = frame_velocity[::10, :]
+            stale.append(filename)
+
+    # parse new or modified files
+    if stale:
+        results = pool.imap(parse_info, stale, chunksize=16) if pool is not None else map(parse_info, stale)
+        for filename, record in zip(stale, results):
+            records[filename.stem] = record
+
+        if cache_path is not None:
+            cached.update(records)
+            _write_info_cache(cache_path, cached)
+
+    return records
+
+
+def _write_info_cache(cache_path, records):
+    """Write records to the columnar H5 cache, see load_info"""
+    names = sorted(records)
+    lengths = [len(records[name]['timestamp']) for name in names]
+
+    with h5py.File(cache_path, 'w') as f:
+        f.create_dataset('name', data=np.array(names, dtype='S'))
+        f.create_dataset('reason', data=np.array([records[name]['reason'] for name in names], dtype='S'))
+        for key, dtype in [('mtime', np.float64), ('valid', np.bool_), ('startTime', np.float64), ('endTime', np.float64)]:
+            f.create_dataset(key, data=np.array([records[name][key] for name in names], dtype=dtype))
+        f.create_dataset('offset', data=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+        for key in INFO_COLUMNS:
+            f.create_dataset(key, data=np.concatenate([records[name][key] for name in names] + [np.zeros(0)]))
+
+
+def _read_info_cache(cache_path):
+    """Read all records of the columnar H5 cache, see load_info"""
+    with h5py.File(cache_path, 'r') as f:
+        columns = {key: f[key][()] for key in f}
+
+    # cache written before reasons were recorded, parse everything again
+    if 'reason' not in columns:
+        return {}
+
+    records = {}
+    offset = columns['offset']
+    for i, name in enumerate(columns['name']):
+        record = {key: columns[key][i].item() for key in ['mtime', 'valid', 'startTime', 'endTime']}
+        record['reason'] = columns['reason'][i].decode()
+        # locations of each file are views into the cached columns
+        for key in INFO_COLUMNS:
+            record[key] = columns[key][offset[i]:offset[i + 1]]
+        records[name.decode()] = record
+
+    return records
+
+
+def frame_velocity(timestamp, speed, course, start_time, num_frames, hz):
+    '''
+    Function to interpolate the velocity of a video at its kept frames
+
+    The velocity at a frame is linearly interpolated between the locations recorded before and
+    after it, and clamped to the first/last location outside of the recorded time range. Only
+    every 10th frame is kept, to align with the 3hz refresh rate
+
+    Parameters
+    ----------
+    timestamp : ndarray
+        Sorted times of the locations in ms
+
+    speed : ndarray
+        Speed at each location
+
+    course : ndarray
+        Heading at each location in degrees
+
+    start_time : integer
+        Time of the first frame of the video in ms
+
+    num_frames : integer
+        Number of frames in video
+
+    hz : integer
+        Refresh rate of video
+
+    '''
+
+    # create direction vector for every speed and course scalar
+    t = np.radians(course)
+    velocity = np.stack([np.sin(t) * speed, np.cos(t) * speed], axis=1).astype(np.float32)
+
+    # get current time of every kept frame in timestamp (location data is collected every second)
+    t_cur = np.arange(0, num_frames, 10) * 1000 / hz + start_time
+
+    # find last timestamp before t_cur, and the one after it
+    t_prev = np.maximum(np.searchsorted(timestamp, t_cur, side='left') - 1, 0)
+    t_next = np.minimum(t_prev + 1, len(timestamp) - 1)
+
+    # get difference between current time and previous/next time
+    t1 = t_cur - timestamp[t_prev]
+    t2 = timestamp[t_next] - t_cur
+    # frames clamped below are 0 / 0 here, ignore warnings for them
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # normalize differences in time
+        r1 = (t2 / (t1 + t2))[:, None]
+        r2 = (t1 / (t1 + t2))[:, None]
+        # get current velocity between two timestamps
+        frame_velocity = (r1 * velocity[t_prev] + r2 * velocity[t_next]).astype(np.float32)
+
+    # make sure current time is after first time, and last timestamp for locations not reached
+    frame_velocity[t_cur < timestamp[0]] = velocity[0]
+    frame_velocity[(t_cur >= timestamp[0]) & (t_prev == len(timestamp) - 1)] = velocity[-1]
+
     return frame_velocity
 
 
-def check_info(info, locations):
+def check_info(start_time, end_time, columns, num_keys):
     '''
     Author: Jordan Patterson
     
-    Function to ensure json is valid
+    Function to ensure json is valid, filling missing (-1) values from neighbouring locations
+
+    A missing value is taken from the next location if it is present there, otherwise from the
+    previous (already filled) location
 
     Parameters
     ----------
-    locations : array of dicts
-        The locations and associated metrics of a video
+    start_time, end_time : integer
+        Time of the first and last frame of the video in ms
+
+    columns : dict
+        Maps every key of the locations to a 1d float array of its values, filled in place
+
+    num_keys : ndarray
+        Number of keys of each location
+
+    Returns
+    -------
+    reason : string
+        "ok" if the json is valid, otherwise the first problem found, see INFO_REASONS
 
     '''
 
-    if len(locations) == 0:
-        return False
+    if len(num_keys) == 0:
+        return 'empty'
+
+    timestamp = columns['timestamp'].copy()
 
     threshold = 2000
     # check if video starts too early or late
-    if locations[0]['timestamp'] - info['startTime'] > threshold or info['endTime'] - locations[-1]['timestamp'] > threshold:
-        return False
+    if timestamp[0] - start_time > threshold or end_time - timestamp[-1] > threshold:
+        return 'start_end'
+
+    # fill missing values if possible, counting them per location
+    missing = np.zeros(len(num_keys), dtype=np.int64)
+    for key, values in columns.items():
+        raw = values.copy()
+        mask = raw == -1
+        missing += mask
+
+        # value of the next location, treated as missing past the last location
+        following = np.append(raw[1:], -1)
+        from_next = mask & (following != -1)
+        # otherwise use the last present value before it, or the last location if there is none
+        present = np.maximum.accumulate(np.where(mask, -1, np.arange(len(raw))))
+        from_prev = mask & ~from_next
+
+        values[from_next] = following[from_next]
+        values[from_prev] = raw[present[from_prev]]
 
-    failed = 0
     threshold = 1100
-    prev_t = locations[0]['timestamp']
-    # check if data valid
-    for idx, loc in enumerate(locations):
-        cur_t = int(loc['timestamp'])
-
-        # fill missing values if possible
-        for key in loc:
-            if loc[key] == -1:
-                failed += 1
-                try:
-                    if locations[idx + 1][key] != -1:
-                        loc[key] = locations[idx + 1][key]
-                    else:
-                        loc[key] = locations[idx - 1][key]
-                except IndexError:
-                    loc[key] = locations[idx - 1][key]
-
-        # ensure that timestamps are in reasonable range, the required # of keys exist, and enough speed/course data present to fill
-        if cur_t - prev_t > threshold or cur_t - prev_t < 0 or len(loc.keys()) < 6 or failed == 3:
-            return False
-
-        prev_t = cur_t
-
-    return True
+    # time since the previous location (truncated to ms)
+    cur_t = np.trunc(timestamp)
+    diff = cur_t - np.append(timestamp[0], cur_t[:-1])
+
+    # ensure that timestamps are in reasonable range, the required # of keys exist, and enough speed/course data present to fill
+    failures = [
+        ('timestamp_gap', diff > threshold),
+        ('timestamp_order', diff < 0),
+        ('missing_keys', num_keys < 6),
+        ('missing_values', np.cumsum(missing) == 3),
+    ]
+    # report the problem at the earliest location
+    first = [np.argmax(failed) if failed.any() else len(num_keys) for _, failed in failures]
+    if min(first) < len(num_keys):
+        return failures[int(np.argmin(first))][0]
+
+    return 'ok'
@@ -0,0 +1,77 @@
+import os, json, cv2
+import numpy as np
+
+from pathlib import Path
+
+
+def scan_videos(videos, index_path=None, pool=None):
+    '''
+    Function to probe the frame count, framerate and resolution of every video once
+
+    Results are cached in a json index keyed by video path, and an entry is reused on later runs
+    as long as the modification time of its video is unchanged
+
+    Parameters
+    ----------
+    videos : list of PurePath objects
+        Absolute paths to the videos to probe
+
+    index_path : PurePath object
+        Path of the json index to read and update, nothing is cached if None
+
+    pool : multiprocessing.Pool object
+        Pool used to probe videos in parallel, videos are probed in this process if None
+
+    Returns
+    -------
+    metadata : dict
+        Maps the path of each video (as a string) to a dict with keys "mtime", "opened", "frames",
+        "fps", "width" and "height"
+
+    '''
+
+    # load previous results
+    index = {}
+    if index_path is not None and Path(index_path).exists():
+        with open(index_path) as f:
+            index = json.load(f)
+
+    metadata = {}
+    stale = []
+    for video in videos:
+        key = str(video)
+        entry = index.get(key)
+        # reuse entry only if the video has not been modified since it was probed
+        if entry is not None and entry['mtime'] == os.stat(key).st_mtime:
+            metadata[key] = entry
+        else:
+            stale.append(key)
+
+    # probe new or modified videos
+    if stale:
+        results = pool.imap(_probe_video, stale) if pool is not None else map(_probe_video, stale)
+        for key, entry in zip(stale, results):
+            metadata[key] = entry
+
+        if index_path is not None:
+            index.update(metadata)
+            with open(index_path, 'w') as f:
+                json.dump(index, f)
+
+    return metadata
+
+
+def _probe_video(path):
+    """Read the container metadata of a video without decoding any frames"""
+    entry = {'mtime': os.stat(path).st_mtime, 'opened': False, 'frames': 0, 'fps': 0, 'width': 0, 'height': 0}
+
+    video = cv2.VideoCapture(path)
+    if video.isOpened():
+        entry['opened'] = True
+        entry['frames'] = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        entry['fps'] = int(np.rint(video.get(cv2.CAP_PROP_FPS)))
+        entry['width'] = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+        entry['height'] = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    video.release()
+
+    return entry
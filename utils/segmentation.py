@@ -4,23 +4,28 @@ Created on Fri Apr 13 02:09:57 2018
 
 @author: AUSTIN
 """
-from collections import defaultdict
 import numpy as np
 
+# colour of every class id, ids without a colour are black
+PALETTE = np.zeros((256, 3), dtype=np.uint8)
+PALETTE[:19] = [
+    [128, 64, 128], [244, 35,232], [ 70, 70, 70],
+    [102, 102,156], [190,153,153], [153,153,153],
+    [250, 170, 30], [220,220,  0], [107,142, 35],
+    [152,251, 152], [70,130,180], [220, 20,60],
+    [255,  0,  0], [0, 0,  142], [0,  0,  70],
+    [0, 60,  100], [0, 80, 100], [0,  0, 230],
+    [119, 11, 32]
+]
+
 def segmentation_color(pred):
-    color = {
-        0:[128, 64, 128], 1:[244, 35,232], 2:[ 70, 70, 70],
-        3:[102, 102,156], 4:[190,153,153], 5:[153,153,153],
-        6:[250, 170, 30], 7:[220,220,  0], 8:[107,142, 35],
-        9:[152,251, 152], 10:[70,130,180], 11:[220, 20,60],
-        12:[255,  0,  0], 13:[0, 0,  142], 14:[0,  0,  70],
-        15:[0, 60,  100], 16:[0, 80, 100], 17:[0,  0, 230],
-        18:[119, 11, 32]
-    }
-    color = defaultdict(lambda: [0,0,0], color)
-    shape = pred.shape
-    pred = pred.ravel()
-    pred = np.asarray([color[i] for i in pred])
-    pred = pred.reshape(shape[0],shape[1],shape[2],3)
-    return pred.astype(np.uint8)
-    
\ No newline at end of file
+    """Colour an (N, H, W) array of class ids as (N, H, W, 3) uint8 images"""
+    # ids past the palette are clipped to its last (black) entry
+    return np.take(PALETTE, pred, axis=0, mode='clip')
+
+def segmentation_color_tf(pred):
+    """TensorFlow op of segmentation_color, runs in the graph without calling back into Python"""
+    # TensorFlow is only needed to build the graph, not to colour arrays
+    import tensorflow as tf
+    palette = tf.constant(PALETTE, name="palette")
+    return tf.gather(palette, tf.minimum(pred, tf.cast(PALETTE.shape[0] - 1, pred.dtype)))
@@ -0,0 +1,131 @@
+### Pretrained weight import
+
+import os
+import numpy as np
+import tensorflow as tf
+
+
+# shapes of the fully connected AlexNet layers implemented as convolutions
+CONV_SHAPES = {
+    'fc6': (6, 6, 256, 4096),
+    'fc7': (1, 1, 4096, 4096),
+}
+
+
+def convert_weights(npy_path, out_dir=None):
+    '''
+    Function to convert bvlc_alexnet.npy into one .npy file per variable, which can be memory-mapped
+
+    Writes "<layer>_weights.npy" and "<layer>_biases.npy" for every layer, with the fully connected
+    layers reshaped as in CONV_SHAPES. Conversion is skipped if "out_dir" is newer than "npy_path"
+
+    Parameters
+    ----------
+    npy_path : string
+        Path to bvlc_alexnet.npy, a pickled dict mapping layer names to [weights, biases]
+
+    out_dir : string
+        Directory of the converted files, defaults to "npy_path" without extension
+
+    Returns
+    -------
+    out_dir : string
+        Directory of the converted files
+
+    '''
+
+    out_dir = out_dir or os.path.splitext(npy_path)[0]
+    done = os.path.join(out_dir, 'layers.txt')
+    if os.path.exists(done) and os.path.getmtime(done) >= os.path.getmtime(npy_path):
+        return out_dir
+
+    print("Converting {} to {}...".format(npy_path, out_dir))
+    os.makedirs(out_dir, exist_ok=True)
+    weights_dict = np.load(npy_path, encoding='bytes', allow_pickle=True).item()
+    layers = []
+    for layer, (weights, biases) in weights_dict.items():
+        layer = layer.decode() if isinstance(layer, bytes) else layer
+        if layer in CONV_SHAPES:
+            weights = weights.reshape(CONV_SHAPES[layer])
+        np.save(os.path.join(out_dir, layer + '_weights.npy'), weights.astype(np.float32))
+        np.save(os.path.join(out_dir, layer + '_biases.npy'), biases.astype(np.float32))
+        layers.append(layer)
+
+    # list of layers is written last, so an interrupted conversion is done again
+    with open(done, 'w') as f:
+        f.write('\n'.join(sorted(layers)))
+
+    return out_dir
+
+
+def load_weights(layers_dir):
+    '''
+    Function to memory-map the files written by convert_weights
+
+    Returns a dict mapping "<layer>/weights" and "<layer>/biases" to arrays
+    '''
+
+    with open(os.path.join(layers_dir, 'layers.txt')) as f:
+        layers = f.read().split()
+
+    return {layer + '/' + key: np.load(os.path.join(layers_dir, '{}_{}.npy'.format(layer, key)), mmap_mode='r')
+            for layer in layers for key in ['weights', 'biases']}
+
+
+class WeightLoader:
+    '''
+    Assign ops for the pretrained variables of a scope, built once with the rest of the graph
+
+    Every variable "<scope>/<layer>/weights" and "<scope>/<layer>/biases" gets a placeholder and an
+    assign op, so loading weights runs one session call and adds nothing to the graph
+    '''
+
+    def __init__(self, scope='Network'):
+        self.scope = scope
+        self.placeholders = {}
+        self.assign_ops = {}
+        for var in tf.global_variables(scope=scope):
+            name = var.op.name[len(scope) + 1:]
+            if name.count('/') != 1 or not name.endswith(('/weights', '/biases')):
+                continue
+            self.placeholders[name] = tf.placeholder(var.dtype.base_dtype, shape=var.shape)
+            self.assign_ops[name] = var.assign(self.placeholders[name])
+
+    def load(self, sess, weights):
+        '''
+        Function to assign the pretrained weights in a single session call
+
+        Weights missing from the graph (e.g. fc8) or with a different shape are skipped
+
+        Parameters
+        ----------
+        sess : tf.Session object
+            Session holding the variables
+
+        weights : dict
+            Maps "<layer>/weights" and "<layer>/biases" to arrays, see load_weights
+
+        Returns
+        -------
+        loaded : list of strings
+            Names of the layers whose weights and biases were both assigned
+
+        '''
+
+        assigned = []
+        for name, value in sorted(weights.items()):
+            if name not in self.placeholders:
+                continue
+            if tuple(self.placeholders[name].shape.as_list()) != value.shape:
+                print("Warning: skipping {}, shape {} does not match {}".format(
+                    name, value.shape, self.placeholders[name].shape))
+                continue
+            assigned.append(name)
+
+        if assigned:
+            sess.run([self.assign_ops[name] for name in assigned],
+                     feed_dict={self.placeholders[name]: weights[name] for name in assigned})
+
+        layers = {name.split('/')[0] for name in weights}
+        return sorted(layer for layer in layers
+                      if layer + '/weights' in assigned and layer + '/biases' in assigned)